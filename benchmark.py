@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+Load test the checkout flow against a throwaway copy of the site.
+
+Starts the app on a local port against a fresh database (a temporary
+SQLite file unless --db is given), with fakegocardless.py standing in
+for GoCardless and a local sink for SMTP. It then seeds users and runs the real flow
+from concurrent clients: signup or login, /tickets, /pay/choose, bank
+transfer or GoCardless start, gocardless-complete and the webhook.
+Reports throughput and p50/p95/p99 latency for each endpoint, and how
+many checkouts got all the way through.
+
+A step only counts as a success if it returns what the flow expects,
+including where it redirects to, so a login bounced back to the form
+or a checkout sent back to /tickets is an error. Passwords are hashed
+with --log-rounds (default 4), so the run measures checkout rather than
+queueing for bcrypt.
+
+    ./env/bin/python benchmark.py -u 2000 -c 20
+
+CSRF is turned off, as the clients don't scrape forms.
+"""
+from optparse import OptionParser
+from collections import defaultdict
+from flask import Config
+from werkzeug.serving import make_server, WSGIRequestHandler
+import fakegocardless
+import asyncore
+import cookielib
+import logging
+import os
+import random
+import shutil
+import smtpd
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+import Queue
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+class SmtpSink(smtpd.SMTPServer):
+    """
+    Accepts and discards mail, counting it.
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.received = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+
+class NoRedirect(urllib2.HTTPRedirectHandler):
+    # we want to time each hop separately
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+class Timings(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.outcomes = defaultdict(int)
+
+    def add(self, endpoint, elapsed, ok):
+        with self.lock:
+            self.latencies[endpoint].append(elapsed)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def checkout(self, outcome):
+        with self.lock:
+            self.outcomes[outcome] += 1
+
+    def report(self, wall):
+        print "%-22s %7s %6s %8s %8s %8s %8s" % ('endpoint', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+        total = 0
+        for endpoint in sorted(self.latencies):
+            values = sorted(self.latencies[endpoint])
+            total += len(values)
+            print "%-22s %7d %6d %8.1f %8.1f %8.1f %8.1f" % (endpoint, len(values), self.errors[endpoint],
+                len(values) / wall, percentile(values, 50) * 1000, percentile(values, 95) * 1000,
+                percentile(values, 99) * 1000)
+        print "%-22s %7d %6d %8.1f" % ('all', total, sum(self.errors.values()), total / wall)
+        print
+        failed = sum(n for outcome, n in self.outcomes.items() if outcome not in ('completed', 'canceled'))
+        print "checkouts: %d completed, %d canceled at GoCardless, %d failed" % \
+            (self.outcomes['completed'], self.outcomes['canceled'], failed)
+        for outcome in sorted(self.outcomes):
+            if outcome not in ('completed', 'canceled'):
+                print "  %s: %d" % (outcome, self.outcomes[outcome])
+        return failed
+
+def percentile(values, p):
+    # nearest rank, on already sorted values
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class Client(object):
+    """
+    One browser: keeps its cookies, doesn't follow redirects.
+    """
+    def __init__(self, base, timings):
+        self.base = base
+        self.timings = timings
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookielib.CookieJar()), NoRedirect())
+
+    def request(self, endpoint, path, data=None, headers={}, expect=(200,), goes_to=None):
+        """
+        Returns (ok, code, location, body). With goes_to, the response must
+        be a redirect to a URL containing it.
+        """
+        if isinstance(data, dict):
+            data = urllib.urlencode(data)
+        if not path.startswith('http'):
+            path = self.base + path
+
+        start = time.time()
+        try:
+            resp = self.opener.open(urllib2.Request(path, data, headers))
+            code, location, body = resp.getcode(), None, resp.read()
+        except urllib2.HTTPError, e:
+            code, location, body = e.code, e.headers.get('Location'), e.read()
+        except (urllib2.URLError, socket.error), e:
+            code, location, body = None, None, str(e)
+        if goes_to is not None:
+            ok = code == 302 and goes_to in (location or '')
+        else:
+            ok = code in expect
+        self.timings.add(endpoint, time.time() - start, ok)
+        return ok, code, location, body
+
+class Checkout(object):
+    def __init__(self, options, base, timings):
+        self.options = options
+        self.base = base
+        self.timings = timings
+
+    def run(self, n):
+        """
+        One checkout, returning 'completed', 'canceled', or which step failed.
+        """
+        c = Client(self.base, self.timings)
+        if random.random() < self.options.signups:
+            ok, code, location, body = c.request('signup', '/signup', {'name': 'Bench %d' % n,
+                'email': 'bench-signup-%d@example.invalid' % n,
+                'password': 'benchmark', 'confirm': 'benchmark'}, goes_to='/tickets')
+            if not ok:
+                return 'failed at signup'
+        else:
+            ok, code, location, body = c.request('login', '/login', {'email': 'bench-%d@example.invalid' % n,
+                'password': 'benchmark'}, goes_to='/tickets')
+            if not ok:
+                return 'failed at login'
+
+        steps = [
+            ('tickets', '/tickets', None, None),
+            ('tickets_post', '/tickets', {'count': random.randint(1, self.options.tickets)}, '/pay/choose'),
+            ('pay_choose', '/pay/choose', None, None),
+        ]
+        for endpoint, path, data, goes_to in steps:
+            ok, code, location, body = c.request(endpoint, path, data, goes_to=goes_to)
+            if not ok:
+                return 'failed at %s' % endpoint
+
+        outcome = 'completed'
+        if random.random() < self.options.gocardless:
+            ok, code, location, body = c.request('gocardless_start', '/pay/gocardless-start', {},
+                goes_to='/connect/bills/new')
+            if not ok:
+                return 'failed at gocardless_start'
+
+            # the fake sends us straight back, and the webhook follows
+            ok, code, location, body = c.request('(fake) bill page', location, goes_to='/pay/gocardless-')
+            if not ok:
+                return 'failed at (fake) bill page'
+            if '/pay/gocardless-complete' in location:
+                ok, code, location, body = c.request('gocardless_complete', location,
+                    goes_to='/pay/gocardless-waiting')
+                if not ok:
+                    return 'failed at gocardless_complete'
+            else:
+                ok, code, location, body = c.request('gocardless_cancel', location)
+                if not ok:
+                    return 'failed at gocardless_cancel'
+                outcome = 'canceled'
+        else:
+            ok, code, location, body = c.request('transfer_start', '/pay/transfer-start', {},
+                goes_to='/pay/transfer-waiting')
+            if not ok:
+                return 'failed at transfer_start'
+            ok, code, location, body = c.request('transfer_waiting', location)
+            if not ok:
+                return 'failed at transfer_waiting'
+
+        c.request('logout', '/logout', expect=(302,))
+        return outcome
+
+def base_settings(options):
+    return options.settings or os.environ.get('SETTINGS_FILE') or 'config/development.cfg'
+
+def write_settings(options, tmpdir, mail_port, gocardless_url):
+    base = base_settings(options)
+    db = options.db or 'sqlite:///%s' % os.path.join(tmpdir, 'benchmark.db')
+
+    settings = os.path.join(tmpdir, 'benchmark.cfg')
+    out = open(settings, 'w')
+    out.write(open(base).read())
+    out.write('\n# benchmark overrides\n')
+    out.write('SQLALCHEMY_DATABASE_URI = %r\n' % db)
+    out.write('MAIL_SERVER = "127.0.0.1"\nMAIL_PORT = %d\n' % mail_port)
+    out.write('GOCARDLESS_BASE_URL = %r\n' % gocardless_url)
+    out.write('DEBUG = False\nCSRF_ENABLED = False\nPAYMENTS = True\n')
+    out.write('BCRYPT_LOG_ROUNDS = %d\n' % options.log_rounds)
+    out.close()
+    return settings
+
+def seed(options):
+    from main import db
+    from migrations import migrate
+    from models import User, TicketType
+    from models.ticket import ticket_types
+
+    migrate()
+    capacity = options.capacity or options.users * options.tickets
+    db.session.add(TicketType('Prepay Camp Ticket', capacity, options.tickets, 30))
+
+    # one real hash, at --log-rounds, shared by everyone
+    user = User('bench-0@example.invalid', 'Bench 0')
+    user.set_password('benchmark')
+    db.session.add(user)
+    db.session.flush()
+    db.session.execute(User.__table__.insert(), [
+        {'email': 'bench-%d@example.invalid' % n, 'name': 'Bench %d' % n,
+         'password': user.password, 'admin': False}
+        for n in range(1, options.users)])
+    db.session.commit()
+    ticket_types.expire()
+
+def drain(sink):
+    from main import db
+    from models import GoCardlessWebhook
+    from utils import SendEmail
+
+    start = time.time()
+    hooks = GoCardlessWebhook.query.filter(GoCardlessWebhook.processed == None).all()
+    for hook in hooks:
+        hook.process()
+        db.session.commit()
+    print "processed %d webhooks in %.2fs" % (len(hooks), time.time() - start)
+
+    start = time.time()
+    SendEmail().run(100, False, 0)
+    print "delivered %d emails in %.2fs" % (sink.received, time.time() - start)
+
+def serve(app):
+    # a threaded server on a free port, returning it and its URL
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever).start()
+    return server, 'http://127.0.0.1:%d' % server.socket.getsockname()[1]
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-u', '--users', type=int, default=1000, help='users to seed, and checkouts to run')
+    parser.add_option('-c', '--concurrency', type=int, default=10, help='concurrent clients')
+    parser.add_option('-s', '--signups', type=float, default=0.2, help='fraction of checkouts that sign up rather than log in')
+    parser.add_option('-g', '--gocardless', type=float, default=0.5, help='fraction of checkouts paying by GoCardless')
+    parser.add_option('-t', '--tickets', type=int, default=4, help='most tickets per checkout, and the per-user limit')
+    parser.add_option('--log-rounds', type=int, default=4, help='bcrypt cost for the seeded and signed up users')
+    parser.add_option('--capacity', type=int, help='prepay capacity (default: enough for everyone)')
+    parser.add_option('--gc-latency', type=float, default=0.2, help='seconds each fake GoCardless request takes')
+    parser.add_option('--gc-failure-rate', type=float, default=0, help='chance a GoCardless confirm fails')
+    parser.add_option('--gc-cancel-rate', type=float, default=0, help='chance a customer cancels on the GoCardless page')
+    parser.add_option('--webhook-delay', type=float, default=0.1, help='seconds from confirm to webhook')
+    parser.add_option('--db', help='database URL to use instead of a temporary SQLite file; must be empty')
+    parser.add_option('--settings', help='settings file to start from (default: $SETTINGS_FILE or config/development.cfg)')
+    parser.add_option('--keep', action='store_true', help="keep the temporary directory")
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='emf-benchmark-')
+    sink = SmtpSink()
+    threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1}).start()
+
+    try:
+        config = Config('.')
+        config.from_pyfile(os.path.abspath(base_settings(options)))
+        timings = Timings()
+        def webhook_answered(elapsed, status):
+            timings.add('gocardless_webhook', elapsed, status == 200)
+        fake = fakegocardless.make_app(config['GOCARDLESS_APP_ID'], config['GOCARDLESS_APP_SECRET'],
+            latency=options.gc_latency, failure_rate=options.gc_failure_rate,
+            cancel_rate=options.gc_cancel_rate, webhook_delay=options.webhook_delay,
+            observer=webhook_answered)
+        fake_server, fake_base = serve(fake)
+
+        os.environ['SETTINGS_FILE'] = write_settings(options, tmpdir, sink.port, fake_base)
+        from main import app
+        logging.getLogger().setLevel(logging.WARNING)
+
+        seed(options)
+        print "seeded %d users" % options.users
+
+        server, base = serve(app)
+        fake.config['WEBHOOK_URL'] = base + '/gocardless-webhook'
+
+        checkout = Checkout(options, base, timings)
+        queue = Queue.Queue()
+        for n in range(options.users):
+            queue.put(n)
+
+        def worker():
+            while True:
+                try:
+                    n = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                timings.checkout(checkout.run(n))
+
+        start = time.time()
+        workers = [threading.Thread(target=worker) for i in range(options.concurrency)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        wall = time.time() - start
+
+        # let the last webhooks arrive
+        deadline = time.time() + 30
+        while fake.stats['webhooks'] < fake.stats['confirmed'] and time.time() < deadline:
+            time.sleep(0.1)
+
+        server.shutdown()
+        fake_server.shutdown()
+        print "%d checkouts from %d clients in %.2fs (%.1f checkouts/s)" % \
+            (options.users, options.concurrency, wall, options.users / wall)
+        print
+        failed = timings.report(wall)
+        print
+        print "fake GoCardless: %s" % ', '.join('%s %d' % i for i in sorted(fake.stats.items()))
+        print
+        # the processing and mail templates need a request context
+        with app.test_request_context():
+            drain(sink)
+        if failed:
+            return 1
+
+    finally:
+        sink.close()
+        asyncore.close_all()
+        if options.keep:
+            print "kept %s" % tmpdir
+        else:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    sys.exit(main())
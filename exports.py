@@ -0,0 +1,109 @@
+"""
+Streaming exports of users, tickets and payments, as CSV or NDJSON.
+
+Rows are read on a connection of their own with stream_results, which
+is a server-side cursor on PostgreSQL, and written out BATCH rows at a
+time. An export uses the same memory however many rows there are, and
+doesn't need the request's session, which has gone by the time the
+response body is sent.
+"""
+from main import db
+from models.user import User
+from models.ticket import Ticket, TicketType
+from models.payment import Payment, PaymentChange
+from datetime import datetime
+import csv
+import simplejson
+import StringIO
+
+BATCH = 1000
+
+def users():
+    return db.session.query(User.id, User.email, User.name, User.admin). \
+        order_by(User.id)
+
+def tickets():
+    # the attendee list
+    return db.session.query(Ticket.id, Ticket.user_id, User.email, User.name,
+            TicketType.name.label('type'), Ticket.paid, Ticket.released,
+            Ticket.expires, Ticket.payment_id). \
+        join(User, Ticket.user_id == User.id). \
+        join(TicketType, Ticket.type_id == TicketType.id). \
+        order_by(Ticket.id)
+
+def payments():
+    table = Payment.__table__
+    return db.session.query(table.c.id, table.c.user_id, table.c.provider,
+            table.c.state, table.c.amount_pence, table.c.bankref, table.c.gcid). \
+        order_by(table.c.id)
+
+def payment_changes():
+    return db.session.query(PaymentChange.id, PaymentChange.payment_id,
+            PaymentChange.timestamp, PaymentChange.state). \
+        order_by(PaymentChange.id)
+
+EXPORTS = {
+    'users': users,
+    'tickets': tickets,
+    'payments': payments,
+    'payment_changes': payment_changes,
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+def value(v):
+    if isinstance(v, datetime):
+        return v.isoformat()
+    return v
+
+def csv_value(v):
+    v = value(v)
+    if isinstance(v, unicode):
+        return v.encode('utf8')
+    return v
+
+def csv_lines(columns, batches):
+    out = StringIO.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for rows in batches:
+        for row in rows:
+            writer.writerow([csv_value(v) for v in row])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
+
+def ndjson_lines(columns, batches):
+    for rows in batches:
+        yield ''.join(simplejson.dumps(dict(zip(columns, [value(v) for v in row]))) + '\n'
+                      for row in rows)
+
+def export(name, format):
+    """
+    Return a generator of the export's text, one batch of rows at a time.
+    """
+    query = EXPORTS[name]()
+    columns = [c['name'] for c in query.column_descriptions]
+    lines = csv_lines if format == 'csv' else ndjson_lines
+    return stream(query.statement, columns, lines)
+
+def stream(statement, columns, lines):
+    conn = db.engine.connect().execution_options(stream_results=True)
+    try:
+        result = conn.execute(statement)
+
+        def batches():
+            while True:
+                rows = result.fetchmany(BATCH)
+                if not rows:
+                    return
+                yield rows
+
+        for chunk in lines(columns, batches()):
+            yield chunk
+    finally:
+        conn.close()
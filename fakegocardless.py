@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+A local stand-in for GoCardless, for testing and benchmarking offline.
+
+Point the site at it with GOCARDLESS_BASE_URL in the settings file:
+
+    GOCARDLESS_BASE_URL="http://localhost:5001"
+
+and run it with the same settings, so it knows the app secret:
+
+    SETTINGS_FILE=./config/development.cfg ./env/bin/python fakegocardless.py
+
+The customer is sent straight back from the bill page with signed
+confirm parameters, as if they'd paid. Once the site confirms the bill,
+a signed 'paid' webhook is sent to GOCARDLESS_WEBHOOK_URL. Latency and
+failure rates can be set with options, or with FAKE_GOCARDLESS_*
+settings.
+"""
+from flask import Flask, request, redirect, jsonify
+from gocardless.utils import generate_signature
+from optparse import OptionParser
+from urlparse import urlparse, parse_qsl, urlunparse
+from urllib import urlencode
+import base64
+import os
+import random
+import simplejson
+import threading
+import time
+import urllib2
+
+def add_params(url, params):
+    parts = list(urlparse(url))
+    parts[4] = urlencode(parse_qsl(parts[4]) + sorted(params.items()))
+    return urlunparse(parts)
+
+def make_app(app_id, app_secret, webhook_url=None, latency=0, failure_rate=0,
+             cancel_rate=0, webhook_delay=1, webhook_failure_rate=0, webhook_attempts=5,
+             observer=None):
+    """
+    Build the fake. failure_rate is the chance a confirm call fails,
+    cancel_rate the chance the customer cancels on the bill page, and
+    webhook_failure_rate the chance each webhook delivery is dropped
+    (it's retried, as GoCardless does).
+
+    The webhook URL can be changed later through fake.config['WEBHOOK_URL'].
+    observer, if given, is called with (seconds, status) for each webhook
+    the site answers. Counters are in fake.stats.
+    """
+    fake = Flask(__name__)
+    fake.config['WEBHOOK_URL'] = webhook_url
+    # bill id -> {'amount', 'state'}
+    bills = {}
+    lock = threading.Lock()
+    stats = fake.stats = {'bills': 0, 'canceled': 0, 'confirmed': 0, 'confirm_failures': 0,
+                          'webhooks': 0, 'webhook_failures': 0}
+
+    def count(name):
+        with lock:
+            stats[name] += 1
+
+    # the URL the site reaches us on, for resource URIs
+    request_base = ['http://localhost']
+
+    def delay():
+        if latency:
+            time.sleep(latency)
+
+    def error(message, status=200):
+        # the client library only looks for 'error' in the body
+        resp = jsonify(error=[message])
+        resp.status_code = status
+        return resp
+
+    def send_webhook(bill_id, amount):
+        payload = {
+            'resource_type': 'bill',
+            'action': 'paid',
+            'bills': [{'id': bill_id, 'status': 'paid', 'amount': amount,
+                       'source_type': 'ad_hoc_authorization', 'source_id': 'FAKE',
+                       'uri': '%s/api/v1/bills/%s' % (request_base[0], bill_id)}],
+        }
+        payload['signature'] = generate_signature(payload, app_secret)
+        body = simplejson.dumps({'payload': payload})
+
+        for attempt in range(webhook_attempts):
+            time.sleep(webhook_delay * 2 ** attempt)
+            if random.random() < webhook_failure_rate:
+                count('webhook_failures')
+                continue
+            start = time.time()
+            try:
+                status = urllib2.urlopen(urllib2.Request(fake.config['WEBHOOK_URL'], body,
+                    {'Content-Type': 'application/json'})).getcode()
+            except urllib2.HTTPError, e:
+                status = e.code
+            except (urllib2.URLError, IOError):
+                status = None
+            if observer:
+                observer(time.time() - start, status)
+            if status != 200:
+                count('webhook_failures')
+                continue
+            count('webhooks')
+            return
+
+    @fake.route('/connect/bills/new')
+    def new_bill():
+        delay()
+        params = dict(request.args.items())
+        signature = params.pop('signature', None)
+        if signature != generate_signature(params, app_secret):
+            return ('Invalid signature', 403)
+        if params.get('client_id') != app_id:
+            return ('Unknown client', 403)
+
+        if random.random() < cancel_rate:
+            count('canceled')
+            return redirect(params['cancel_uri'])
+
+        bill_id = 'FAKE' + base64.b32encode(os.urandom(10))
+        with lock:
+            bills[bill_id] = {'amount': params.get('bill[amount]'), 'state': 'pending'}
+        count('bills')
+
+        request_base[0] = request.host_url.rstrip('/')
+        resource = {
+            'resource_id': bill_id,
+            'resource_type': 'bill',
+            'resource_uri': '%s/api/v1/bills/%s' % (request_base[0], bill_id),
+        }
+        if 'state' in params:
+            resource['state'] = params['state']
+        resource['signature'] = generate_signature(resource, app_secret)
+        return redirect(add_params(params['redirect_uri'], resource))
+
+    @fake.route('/api/v1/confirm', methods=['POST'])
+    def confirm():
+        delay()
+        auth = request.authorization
+        if not auth or auth.username != app_id or auth.password != app_secret:
+            return error('Invalid credentials', 401)
+
+        data = simplejson.loads(request.data)
+        with lock:
+            bill = bills.get(data.get('resource_id'))
+        if bill is None:
+            return error('Unknown resource')
+
+        if random.random() < failure_rate:
+            count('confirm_failures')
+            return error('Simulated failure')
+
+        with lock:
+            already = bill['state'] != 'pending'
+            bill['state'] = 'paid'
+        if not already:
+            count('confirmed')
+            threading.Thread(target=send_webhook, args=(data['resource_id'], bill['amount'])).start()
+        return jsonify(success=True)
+
+    @fake.route('/stats')
+    def fake_stats():
+        with lock:
+            return jsonify(stats)
+
+    return fake
+
+def main():
+    config = Flask(__name__).config
+    if os.environ.get('SETTINGS_FILE'):
+        config.from_envvar('SETTINGS_FILE')
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--port', type=int, default=5001)
+    parser.add_option('-w', '--webhook-url', default=config.get('GOCARDLESS_WEBHOOK_URL', 'http://localhost:5000/gocardless-webhook'))
+    parser.add_option('-l', '--latency', type=float, default=config.get('FAKE_GOCARDLESS_LATENCY', 0),
+                      help='seconds added to each request')
+    parser.add_option('-f', '--failure-rate', type=float, default=config.get('FAKE_GOCARDLESS_FAILURE_RATE', 0),
+                      help='chance a confirm call fails')
+    parser.add_option('-c', '--cancel-rate', type=float, default=config.get('FAKE_GOCARDLESS_CANCEL_RATE', 0),
+                      help='chance the customer cancels on the bill page')
+    parser.add_option('-d', '--webhook-delay', type=float, default=config.get('FAKE_GOCARDLESS_WEBHOOK_DELAY', 1),
+                      help='seconds before the webhook, doubled on each retry')
+    parser.add_option('-x', '--webhook-failure-rate', type=float, default=config.get('FAKE_GOCARDLESS_WEBHOOK_FAILURE_RATE', 0),
+                      help='chance each webhook delivery is dropped')
+    options, args = parser.parse_args()
+
+    if 'GOCARDLESS_APP_ID' not in config:
+        parser.error('set SETTINGS_FILE to the site settings, for the GoCardless app id and secret')
+
+    fake = make_app(config['GOCARDLESS_APP_ID'], config['GOCARDLESS_APP_SECRET'], options.webhook_url,
+                    options.latency, options.failure_rate, options.cancel_rate,
+                    options.webhook_delay, options.webhook_failure_rate)
+    fake.run(port=options.port, threaded=True, use_reloader=False)
+
+if __name__ == '__main__':
+    main()
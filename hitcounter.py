@@ -0,0 +1,33 @@
+"""
+Hit and miss counts for the in-process caches, shown on /admin/profile.
+Counting is always on, as it costs next to nothing.
+"""
+import threading
+
+class HitCounter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def summary(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': float(self.hits) / total if total else None}
+
+caches = {}
+
+def hit_counter(name):
+    return caches.setdefault(name, HitCounter())
+
+def cache_summary():
+    return [dict(c.summary(), name=name) for name, c in sorted(caches.items())]
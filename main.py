@@ -49,13 +49,20 @@ gocardless.set_details(app_id=app.config['GOCARDLESS_APP_ID'],
                         access_token=app.config['GOCARDLESS_ACCESS_TOKEN'],
                         merchant_id=app.config['GOCARDLESS_MERCHANT_ID'])
 
+if app.config.get('GOCARDLESS_BASE_URL'):
+    # e.g. fakegocardless.py, for testing offline
+    gocardless.Client.base_url = app.config['GOCARDLESS_BASE_URL']
+
 from views import *
 from models import *
-db.create_all()
+
+if app.config.get('PROFILING'):
+    import profiling
+    profiling.setup(app, db)
 
 @login_manager.user_loader
 def load_user(userid):
-    return User.query.filter_by(id=userid).first()
+    return user_cache.get(int(userid))
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,87 @@
+"""
+Schema changes for databases that already exist.
+
+Run with "utils.py migrate" (make migrate) once per deploy; the site
+doesn't migrate on startup, so workers never race each other over DDL.
+
+db.create_all() only creates missing tables, so anything that changes an
+existing table (new columns, new indexes) also needs a migration here.
+Append to MIGRATIONS and never renumber; a fresh database is created
+from the models and stamped with the latest version.
+
+A migration spells out its changes rather than reading them off the
+models, which will have moved on by the time an old database runs it.
+"""
+from main import app, db
+from models import Ticket, SchemaVersion
+from sqlalchemy.engine.reflection import Inspector
+
+def create_indexes(indexes):
+    """
+    Create each (name, table, columns) index that doesn't exist yet. Tables
+    that create_all has just made already have theirs.
+    """
+    inspector = Inspector.from_engine(db.engine)
+    for name, table, columns in indexes:
+        existing = set(i['name'] for i in inspector.get_indexes(table))
+        if name not in existing:
+            db.engine.execute('CREATE INDEX %s ON %s (%s)' % (name, table, ', '.join(columns)))
+
+def add_lookup_indexes():
+    create_indexes([
+        ('ix_ticket_type_paid_expires', 'ticket', ['type_id', 'paid', 'expires']),
+        ('ix_ticket_user_type_expires', 'ticket', ['user_id', 'type_id', 'expires']),
+        ('ix_ticket_payment_id', 'ticket', ['payment_id']),
+        ('ix_payment_user_id', 'payment', ['user_id']),
+        ('ix_payment_state_provider', 'payment', ['state', 'provider']),
+        ('ix_payment_change_payment_timestamp', 'payment_change', ['payment_id', 'timestamp']),
+        ('ix_password_reset_email_token', 'password_reset', ['email', 'token']),
+        ('ix_email_queue_sent_next_attempt', 'email_queue', ['sent', 'next_attempt']),
+        ('ix_gocardless_webhook_processed', 'gocardless_webhook', ['processed', 'error']),
+    ])
+
+def add_ticket_released():
+    inspector = Inspector.from_engine(db.engine)
+    if 'released' not in set(c['name'] for c in inspector.get_columns('ticket')):
+        false = '0' if db.engine.dialect.name == 'sqlite' else 'false'
+        db.engine.execute('ALTER TABLE ticket ADD COLUMN released BOOLEAN NOT NULL DEFAULT %s' % false)
+    create_indexes([
+        ('ix_ticket_type_paid_released', 'ticket', ['type_id', 'paid', 'released']),
+        ('ix_ticket_released_paid_expires', 'ticket', ['released', 'paid', 'expires']),
+    ])
+
+def add_queue_token_entered():
+    # create_all has made the table with the column if the waiting room is new
+    inspector = Inspector.from_engine(db.engine)
+    if 'entered' not in set(c['name'] for c in inspector.get_columns('queue_token')):
+        datetime = 'DATETIME' if db.engine.dialect.name == 'sqlite' else 'TIMESTAMP'
+        db.engine.execute('ALTER TABLE queue_token ADD COLUMN entered %s' % datetime)
+    create_indexes([
+        ('ix_queue_token_entered', 'queue_token', ['entered']),
+    ])
+
+MIGRATIONS = [
+    (1, 'indexes for ticket, payment and lookup columns', add_lookup_indexes),
+    (2, 'ticket.released, set by the expiry sweeper', add_ticket_released),
+    (3, 'queue_token.entered, for visitors who came back', add_queue_token_entered),
+]
+
+def migrate():
+    fresh = not db.engine.has_table(Ticket.__tablename__)
+    db.create_all()
+
+    if fresh:
+        # create_all has just built the latest schema
+        for version, name, fn in MIGRATIONS:
+            db.session.add(SchemaVersion(version, name))
+        db.session.commit()
+        return
+
+    current = SchemaVersion.current()
+    for version, name, fn in MIGRATIONS:
+        if version <= current:
+            continue
+        app.logger.info('Applying migration %s: %s', version, name)
+        fn()
+        db.session.add(SchemaVersion(version, name))
+        db.session.commit()
@@ -1,3 +1,7 @@
+from cache import *
+from schema import *
 from user import *
 from payment import *
 from ticket import *
+from outbox import *
+from admission import *
@@ -0,0 +1,60 @@
+from main import db
+from sqlalchemy import func
+from datetime import datetime
+
+class QueueToken(db.Model):
+    """
+    A place in the waiting room. The id is the position in the queue,
+    admitted is set when the queue reaches it, and entered when its
+    holder comes back and goes through to the checkout.
+    """
+    __tablename__ = 'queue_token'
+    id = db.Column(db.Integer, primary_key=True)
+    created = db.Column(db.DateTime, nullable=False)
+    admitted = db.Column(db.DateTime)
+    entered = db.Column(db.DateTime)
+    __table_args__ = (
+        # recent admissions, counted against the tickets left
+        db.Index('ix_queue_token_admitted', 'admitted'),
+        db.Index('ix_queue_token_entered', 'entered'),
+    )
+
+    def __init__(self, created=None):
+        self.created = created or datetime.utcnow()
+
+    @classmethod
+    def clean(cls, before):
+        """
+        Delete tokens created before before, returning how many. The
+        newest token is always kept, so SQLite never hands out its id
+        again to someone who'd then be behind the queue. Doesn't commit.
+        """
+        newest = db.session.query(func.max(cls.id)).scalar()
+        if newest is None:
+            return 0
+        return cls.query.filter(cls.created < before). \
+            filter(cls.id < newest). \
+            delete(synchronize_session=False)
+
+class QueueState(db.Model):
+    """
+    How far the waiting room has got, shared by every process. There's
+    only ever the one row.
+    """
+    __tablename__ = 'queue_state'
+    id = db.Column(db.Integer, primary_key=True)
+    admitted_upto = db.Column(db.Integer, nullable=False)
+    advanced = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self):
+        self.id = 1
+        self.admitted_upto = 0
+        self.advanced = datetime.utcnow()
+
+    @classmethod
+    def get(cls):
+        state = cls.query.get(1)
+        if state is None:
+            state = cls()
+            db.session.add(state)
+        return state
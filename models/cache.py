@@ -0,0 +1,27 @@
+from main import db
+
+class CacheVersion(db.Model):
+    """
+    Version numbers for data that each process caches in memory. Bump the
+    version in the same transaction as the change, and other processes
+    will reload the next time they check.
+    """
+    __tablename__ = 'cache_version'
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.version = version
+
+    @classmethod
+    def get(cls, name):
+        return db.session.query(cls.version).filter_by(name=name).scalar() or 0
+
+    @classmethod
+    def bump(cls, name):
+        updated = cls.query.filter_by(name=name). \
+            update({cls.version: cls.version + 1}, synchronize_session=False)
+        if not updated:
+            db.session.add(cls(name, 1))
+
@@ -0,0 +1,49 @@
+from main import db
+from flaskext.mail import Message
+from datetime import datetime, timedelta
+import simplejson
+
+class QueuedEmail(db.Model):
+    """
+    An email waiting to be sent by the sendmail command in utils.py.
+
+    Add these to the session instead of calling mail.send() so that views
+    don't wait on the mail server, and the email goes out only if the
+    transaction that caused it commits.
+    """
+    __tablename__ = 'email_queue'
+    id = db.Column(db.Integer, primary_key=True)
+    created = db.Column(db.DateTime, nullable=False)
+    sender = db.Column(db.String, nullable=False)
+    recipients = db.Column(db.String, nullable=False)
+    subject = db.Column(db.String, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(db.DateTime, nullable=False)
+    sent = db.Column(db.DateTime)
+    error = db.Column(db.String)
+    __table_args__ = (
+        db.Index('ix_email_queue_sent_next_attempt', 'sent', 'next_attempt'),
+    )
+
+    def __init__(self, msg):
+        self.sender = msg.sender
+        self.recipients = simplejson.dumps(msg.recipients)
+        self.subject = msg.subject
+        self.body = msg.body
+        self.attempts = 0
+        self.created = self.next_attempt = datetime.utcnow()
+
+    def message(self):
+        return Message(self.subject, sender=self.sender,
+            recipients=simplejson.loads(self.recipients), body=self.body)
+
+    def failed(self, error):
+        # 2, 4, 8... minutes, capped at a few hours
+        self.attempts += 1
+        self.error = str(error)
+        self.next_attempt = datetime.utcnow() + timedelta(minutes=min(2 ** self.attempts, 240))
+
+    def __repr__(self):
+        return "<QueuedEmail: %s to %s, attempts: %s, sent: %s>" % (self.id, self.recipients, self.attempts, self.sent)
+
@@ -1,12 +1,23 @@
-from main import db, gocardless
-from flask import url_for
+from main import app, db, gocardless
+from flask import url_for, render_template
+from flaskext.mail import Message
+from sqlalchemy.orm import joinedload, reconstructor, Session
+from sqlalchemy import or_, event
+from models.outbox import QueuedEmail
+from models.ticket import Ticket
 
-import random
+import hashlib
+import hmac
 import re
+import simplejson
+from datetime import datetime
 from decimal import Decimal
 
 safechars = "2346789BCDFGHJKMPQRTVWXY"
 
+class PaymentStateError(Exception):
+    pass
+
 class Payment(db.Model):
 
     __tablename__ = 'payment'
@@ -15,12 +26,52 @@ class Payment(db.Model):
     provider = db.Column(db.String, nullable=False)
     amount_pence = db.Column(db.Integer, nullable=False)
     state = db.Column(db.String, nullable=False, default='new')
-    changes = db.relationship('PaymentChange', lazy='dynamic', backref='payment')
+    changes = db.relationship('PaymentChange', lazy='dynamic', backref='payment', cascade='all')
     tickets = db.relationship('Ticket', lazy='dynamic', backref='payment', cascade='all')
-    __mapper_args__ = {'polymorphic_on': provider}
+    # load bankref/gcid with the payment rather than one query per row
+    __mapper_args__ = {'polymorphic_on': provider, 'with_polymorphic': '*'}
+    __table_args__ = (
+        db.Index('ix_payment_user_id', 'user_id'),
+        # outstanding payments for reconcile
+        db.Index('ix_payment_state_provider', 'state', 'provider'),
+    )
+
+    # the states each state can move to. Late bank transfers can arrive
+    # for expired payments.
+    transitions = {
+        'new': ('inprogress', 'canceled', 'failed'),
+        'inprogress': ('paid', 'canceled', 'failed', 'expired'),
+        'expired': ('paid', 'canceled'),
+        'paid': (),
+        'canceled': (),
+        'failed': (),
+    }
 
     def __init__(self, amount):
         self.amount = amount
+        self.state = 'new'
+        self.pending_changes = [PaymentChange('new')]
+
+    @reconstructor
+    def init_on_load(self):
+        self.pending_changes = []
+
+    def set_state(self, state):
+        """
+        Move the payment to a new state, raising PaymentStateError if it
+        can't go there from here. The change is written to payment_change
+        when the payment is next flushed.
+        """
+        if state == self.state:
+            return
+        if state not in self.transitions.get(self.state, ()):
+            raise PaymentStateError('Payment %s can\'t go from %s to %s' % (self.id, self.state, state))
+        self.state = state
+        self.pending_changes.append(PaymentChange(state))
+
+    def history(self):
+        return PaymentChange.query.filter_by(payment_id=self.id). \
+            order_by(PaymentChange.timestamp, PaymentChange.id)
 
     @property
     def amount(self):
@@ -35,17 +86,92 @@ class BankPayment(Payment):
     name = 'Bank transfer'
 
     __mapper_args__ = {'polymorphic_identity': 'banktransfer'}
+    # allocated by allocate_bankrefs when the payment is first flushed
     bankref = db.Column(db.String, unique=True)
 
-    def __init__(self, amount):
-        Payment.__init__(self, amount)
-
-        # not cryptographic
-        self.bankref = ''.join(random.sample(safechars, 8))
-
     def __repr__(self):
         return "<BankPayment: %s %s>" % (self.state, self.bankref)
 
+class BankrefSequence(db.Model):
+    """
+    Numbers for bankrefs. Each one is a row insert rather than an UPDATE
+    of a single counter, so concurrent checkouts don't queue up behind
+    a row lock that's held until they commit.
+    """
+    __tablename__ = 'bankref_sequence'
+    id = db.Column(db.Integer, primary_key=True)
+    # don't reuse numbers if old rows are ever cleared out
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    @classmethod
+    def next(cls, session):
+        result = session.execute(cls.__table__.insert())
+        return result.inserted_primary_key[0]
+
+# bankrefs are BANKREF_DIGITS characters from safechars and a check character
+BANKREF_DIGITS = 7
+BANKREF_SPACE = len(safechars) ** BANKREF_DIGITS
+# the permutation works on 2 * half_bits bits, walking until it lands in BANKREF_SPACE
+half_bits = 17
+feistel_rounds = 8
+
+def bankref_key():
+    # changing this once refs have been handed out could repeat them
+    return str(app.config.get('BANKREF_KEY') or app.config['SECRET_KEY'])
+
+def permute(n, key):
+    """
+    A keyed permutation of range(BANKREF_SPACE), so consecutive numbers
+    give unrelated-looking refs.
+    """
+    mask = (1 << half_bits) - 1
+    while True:
+        left, right = n >> half_bits, n & mask
+        for i in range(feistel_rounds):
+            f = hmac.new(key, '%d:%d' % (i, right), hashlib.sha1).hexdigest()
+            left, right = right, left ^ (int(f[:8], 16) & mask)
+        n = (left << half_bits) | right
+        if n < BANKREF_SPACE:
+            return n
+
+def check_char(digits):
+    # Luhn mod N, which catches any single mistyped character and
+    # most swaps of neighbouring ones
+    base = len(safechars)
+    total = 0
+    factor = 2
+    for c in reversed(digits):
+        addend = factor * safechars.index(c)
+        total += addend // base + addend % base
+        factor = 3 - factor
+    return safechars[-total % base]
+
+def bankref_for(number):
+    n = permute(number % BANKREF_SPACE, bankref_key())
+    digits = ''
+    for i in range(BANKREF_DIGITS):
+        n, d = divmod(n, len(safechars))
+        digits = safechars[d] + digits
+    return digits + check_char(digits)
+
+def bankref_valid(ref):
+    """
+    Whether ref's check character is right. Refs handed out before we had
+    check characters only pass by chance.
+    """
+    return len(ref) == BANKREF_DIGITS + 1 and \
+        all(c in safechars for c in ref) and \
+        check_char(ref[:-1]) == ref[-1]
+
+@event.listens_for(Session, 'before_flush')
+def allocate_bankrefs(session, flush_context, instances):
+    # this runs again if the flush is rolled back and retried, so a
+    # payment never keeps a number that was rolled back with it
+    for obj in session.new:
+        if isinstance(obj, BankPayment):
+            obj.bankref = bankref_for(BankrefSequence.next(session))
+
+
 class GoCardlessPayment(Payment):
     name = 'GoCardless payment'
 
@@ -58,12 +184,193 @@ class GoCardlessPayment(Payment):
             cancel_uri=url_for('gocardless_cancel', payment=self.id, _external=True))
 
 
+def expire_payments(limit):
+    """
+    Mark up to limit inprogress payments as expired once all their
+    tickets have been released, recording the change. Returns the
+    payments. Doesn't commit.
+    """
+    payments = Payment.query.filter_by(state='inprogress'). \
+        filter(Payment.tickets.any(Ticket.released == True)). \
+        filter(~Payment.tickets.any(or_(Ticket.paid == True, Ticket.released == False))). \
+        order_by(Payment.id).limit(limit).all()
+
+    for payment in payments:
+        payment.set_state('expired')
+    return payments
+
+
 class PaymentChange(db.Model):
     __tablename__ = 'payment_change'
     id = db.Column(db.Integer, primary_key=True)
     payment_id = db.Column(db.Integer, db.ForeignKey('payment.id'), nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False)
     state = db.Column(db.String, nullable=False)
+    __table_args__ = (
+        db.Index('ix_payment_change_payment_timestamp', 'payment_id', 'timestamp'),
+    )
 
     def __init__(self, state):
         self.state = state
+        self.timestamp = datetime.utcnow()
+
+    @classmethod
+    def history(cls, payment_ids):
+        """
+        The changes to several payments, as {payment id: [changes, oldest first]}.
+        """
+        changes = dict((id, []) for id in payment_ids)
+        if changes:
+            for change in cls.query.filter(cls.payment_id.in_(payment_ids)). \
+                    order_by(cls.payment_id, cls.timestamp, cls.id):
+                changes[change.payment_id].append(change)
+        return changes
+
+@event.listens_for(Session, 'after_flush')
+def record_payment_changes(session, flush_context):
+    # new payments have their ids by now, and this is still the flush's transaction
+    rows = []
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Payment) and obj.pending_changes:
+            rows.extend({'payment_id': obj.id, 'timestamp': c.timestamp, 'state': c.state}
+                        for c in obj.pending_changes)
+            obj.pending_changes = []
+    if rows:
+        session.execute(PaymentChange.__table__.insert(), rows)
+
+
+class GoCardlessWebhook(db.Model):
+    """
+    A validated webhook payload, stored so we can acknowledge GoCardless
+    straight away and process it later with the processwebhooks command.
+
+    GoCardless redelivers until it gets a 200, so payloads are keyed on
+    their signature and processing is safe to repeat.
+    """
+    __tablename__ = 'gocardless_webhook'
+    id = db.Column(db.Integer, primary_key=True)
+    signature = db.Column(db.String, unique=True, nullable=False)
+    received = db.Column(db.DateTime, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    processed = db.Column(db.DateTime)
+    error = db.Column(db.String)
+    __table_args__ = (
+        db.Index('ix_gocardless_webhook_processed', 'processed', 'error'),
+    )
+
+    def __init__(self, data):
+        self.signature = data['signature']
+        self.payload = simplejson.dumps(data)
+        self.received = datetime.utcnow()
+
+    @property
+    def data(self):
+        return simplejson.loads(self.payload)
+
+    def process(self):
+        """
+        Apply the payload to our payments. Doesn't commit.
+        """
+        data = self.data
+
+        # action can be:
+        #
+        # paid -> money taken from the customers account, at this point we concider the ticket paid.
+        # created -> for subscriptions
+        # failed -> customer is broke
+        # withdrawn -> we actually get the money
+
+        if data['action'] == 'paid':
+            gcids = [bill['id'] for bill in data['bills']]
+            payments = GoCardlessPayment.query.filter(GoCardlessPayment.gcid.in_(gcids)). \
+                options(joinedload('user')).all()
+
+            found = set(p.gcid for p in payments)
+            for gcid in gcids:
+                if gcid not in found:
+                    app.logger.warn('Payment %s not found, ignoring', gcid)
+
+            tickets = {}
+            if payments:
+                for t in Ticket.query.filter(Ticket.payment_id.in_([p.id for p in payments])):
+                    tickets.setdefault(t.payment_id, []).append(t)
+
+            for payment in payments:
+                app.logger.info("Processing payment %s (%s) for user %s",
+                    payment.id, payment.gcid, payment.user.id)
+
+                if payment.state == "paid":
+                    app.logger.info("Payment %s already paid, ignoring", payment.id)
+                    continue
+
+                if payment.state != "inprogress":
+                    app.logger.warning("Old payment state was %s, not 'inprogress'", payment.state)
+
+                try:
+                    payment.set_state("paid")
+                except PaymentStateError, e:
+                    app.logger.error("Not marking payment %s paid: %s", payment.id, e)
+                    continue
+
+                for t in tickets.get(payment.id, []):
+                    t.paid = True
+
+                msg = Message("Your EMF ticket payment has been confirmed", \
+                    sender=app.config.get('TICKETS_EMAIL'),
+                    recipients=[payment.user.email]
+                )
+                msg.body = render_template("tickets-paid-email-gocardless.txt", \
+                    basket={"count" : len(tickets.get(payment.id, [])), "reference" : payment.gcid}, \
+                    user = payment.user, payment=payment)
+                db.session.add(QueuedEmail(msg))
+
+        else:
+            for bill in data['bills']:
+                app.logger.debug('Payment: %s', bill)
+
+        self.processed = datetime.utcnow()
+        self.error = None
+
+
+class BankTransaction(db.Model):
+    """
+    A transaction from a bank statement that the reconcile command has
+    finished with, keyed on its FITID so later runs over a cumulative
+    statement can skip it.
+
+    Transactions we couldn't match, or whose amount was wrong, aren't
+    recorded, so they're retried once the ref fixups are updated.
+    """
+    __tablename__ = 'bank_transaction'
+    id = db.Column(db.Integer, primary_key=True)
+    fitid = db.Column(db.String, unique=True, nullable=False)
+    posted = db.Column(db.DateTime)
+    amount_pence = db.Column(db.Integer, nullable=False)
+    payee = db.Column(db.String)
+    payment_id = db.Column(db.Integer, db.ForeignKey('payment.id'))
+    payment = db.relationship('Payment')
+    processed = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, fitid, posted, amount, payee, payment=None):
+        self.fitid = fitid
+        self.posted = posted
+        self.amount_pence = int(amount * 100)
+        self.payee = payee
+        self.payment = payment
+        self.processed = datetime.utcnow()
+
+    @classmethod
+    def seen(cls, fitids):
+        """
+        Return the subset of fitids that are already in the ledger.
+        """
+        fitids = [f for f in fitids if f]
+        found = set()
+        # keep well under SQLite's limit on bound parameters
+        for i in range(0, len(fitids), 500):
+            q = db.session.query(cls.fitid).filter(cls.fitid.in_(fitids[i:i + 500]))
+            found.update(f for (f,) in q)
+        return found
+
+    def __repr__(self):
+        return "<BankTransaction: %s %s>" % (self.fitid, self.amount_pence)
@@ -0,0 +1,24 @@
+from main import db
+from sqlalchemy import func
+from datetime import datetime
+
+class SchemaVersion(db.Model):
+    """
+    One row per migration applied to this database. See migrations.py.
+    """
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String, nullable=False)
+    applied = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, version, name):
+        self.version = version
+        self.name = name
+        self.applied = datetime.utcnow()
+
+    @classmethod
+    def current(cls):
+        return db.session.query(func.max(cls.version)).scalar() or 0
+
+    def __repr__(self):
+        return "<SchemaVersion: %s %s>" % (self.version, self.name)
@@ -1,18 +1,90 @@
-from main import db
+from main import app, db
+from models.cache import CacheVersion
 from decimal import Decimal
 from datetime import datetime, timedelta
-from sqlalchemy.orm import attributes, Session
-from sqlalchemy import event, or_
+from collections import namedtuple
+from sqlalchemy.orm import attributes, class_mapper, Session
+from sqlalchemy import event, func, select, exists, and_
+from sqlalchemy.exc import OperationalError
+import random
+import threading
+import time
 
-class ConstTicketType(object):
+TicketTypeInfo = namedtuple('TicketTypeInfo', 'id name capacity limit cost')
+
+class TicketTypeCache(object):
+    """
+    Read-through cache of ticket types, shared by every request in the process.
+
+    Holds immutable TicketTypeInfo snapshots rather than ORM objects, so
+    they're safe to use from any session. After TICKET_TYPE_CACHE_TTL
+    seconds we check the ticket_type version and reload if another
+    process has changed it.
+
+    Types are read on a connection of our own, as we're often called from
+    check_capacity in the middle of a flush, and must only ever cache
+    what's been committed.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.by_id = {}
+        self.by_name = {}
+        self.version = None
+        self.checked = 0
+        # set when this process changes a type, until the change commits
+        self.expire_on_commit = False
+
+    def refresh(self):
+        ttl = app.config.get('TICKET_TYPE_CACHE_TTL', 60)
+        with self.lock:
+            if time.time() - self.checked < ttl:
+                return
+
+            conn = db.engine.connect()
+            try:
+                version = conn.execute(select([CacheVersion.version]). \
+                    where(CacheVersion.name == 'ticket_type')).scalar() or 0
+                if version != self.version:
+                    table = TicketType.__table__
+                    types = [TicketTypeInfo(r.id, r.name, r.capacity, r['limit'], Decimal(r.cost_pence) / 100)
+                             for r in conn.execute(select([table]))]
+                    self.by_id = dict((t.id, t) for t in types)
+                    self.by_name = dict((t.name, t) for t in types)
+                    self.version = version
+            finally:
+                conn.close()
+
+            self.checked = time.time()
+
+    def expire(self):
+        self.checked = 0
+
+    def lookup(self, index, key):
+        self.refresh()
+        if key not in index():
+            # may have been added by another process since we last checked
+            self.expire()
+            self.refresh()
+        return index()[key]
+
+    def get(self, id):
+        return self.lookup(lambda: self.by_id, id)
+
+    def get_by_name(self, name):
+        return self.lookup(lambda: self.by_name, name)
+
+    def all(self):
+        self.refresh()
+        return self.by_id.values()
+
+ticket_types = TicketTypeCache()
+
+class CachedTicketType(object):
     def __init__(self, name):
         self.name = name
-        self.val = None
 
     def __get__(self, obj, objtype):
-        if not self.val:
-            self.val = objtype.query.filter_by(name=self.name).one()
-        return self.val
+        return ticket_types.get_by_name(self.name)
 
 class TicketType(db.Model):
     __tablename__ = 'ticket_type'
@@ -28,6 +100,7 @@ class TicketType(db.Model):
         self.capacity = capacity
         self.limit = limit
         self.cost = cost
+        self.stock = TicketStock(None)
 
     @property
     def cost(self):
@@ -37,7 +110,7 @@ class TicketType(db.Model):
     def cost(self, val):
         self.cost_pence = int(val * 100)
 
-    Prepay = ConstTicketType('Prepay Camp Ticket')
+    Prepay = CachedTicketType('Prepay Camp Ticket')
 
 
 class Ticket(db.Model):
@@ -48,44 +121,338 @@ class Ticket(db.Model):
     paid = db.Column(db.Boolean, default=False, nullable=False)
     expires = db.Column(db.DateTime, nullable=False)
     payment_id = db.Column(db.Integer, db.ForeignKey('payment.id'))
+    # set by the expiry sweeper once an unpaid ticket stops holding stock
+    released = db.Column(db.Boolean, default=False, nullable=False)
+    __table_args__ = (
+        db.Index('ix_ticket_type_paid_expires', 'type_id', 'paid', 'expires'),
+        # held tickets by type, for stock recounts
+        db.Index('ix_ticket_type_paid_released', 'type_id', 'paid', 'released'),
+        # tickets for the sweeper to release
+        db.Index('ix_ticket_released_paid_expires', 'released', 'paid', 'expires'),
+        # a user's tickets, and their per-type limit
+        db.Index('ix_ticket_user_type_expires', 'user_id', 'type_id', 'expires'),
+        db.Index('ix_ticket_payment_id', 'payment_id'),
+    )
 
     def __init__(self, type=None, type_id=None):
+        # type can be a TicketType or a cached TicketTypeInfo
         if type:
-            self.type = type
-            self.type_id = type.type_id
-        elif type_id is not None:
-            self.type_id = type_id
-            self.type = TicketType.query.filter_by(id=TicketType.Prepay.id).one()
-        else:
+            type_id = type.id
+        if type_id is None:
             raise ValueError('Type must be specified')
+        self.type_id = type_id
 
         self.expires = datetime.utcnow() + timedelta(hours=2)
 
     def expired(self):
         if self.paid:
             return False
-        return self.expires < datetime.utcnow()
+        return self.released or self.expires < datetime.utcnow()
+
+    @classmethod
+    def issue(cls, type, user_ids, payment=None, expires=None, paid=False):
+        """
+        Create a ticket of type for each entry in user_ids (repeat an id
+        for several tickets) with one executemany INSERT and one capacity
+        check, rather than a flush per ticket. Doesn't commit.
+
+        Raises TicketError if there isn't room for all of them.
+        """
+        if not user_ids:
+            return
+
+        if expires is None:
+            expires = datetime.utcnow() + timedelta(hours=2)
+
+        count = len(user_ids)
+        if paid:
+            take_stock(db.session, type.id, count, 0, count)
+        else:
+            take_stock(db.session, type.id, count, count, 0)
+
+        payment_id = payment.id if payment is not None else None
+        db.session.execute(cls.__table__.insert(), [
+            {'user_id': user_id, 'type_id': type.id, 'paid': paid,
+             'expires': expires, 'payment_id': payment_id}
+            for user_id in user_ids])
+
+    @property
+    def status(self):
+        if self.paid:
+            return 'paid'
+        elif self.expired():
+            return 'expired'
+        return 'pending'
     
     def __repr__(self):
         return "<Ticket: %s, type: %s, paid? %s, expired: %s>" % (self.id, self.type_id, self.paid, str(self.expired()))
 
+class TicketError(Exception):
+    pass
+
+class TicketStock(db.Model):
+    """
+    Running totals of tickets held against each ticket type, kept up to
+    date by check_capacity so we don't have to count the ticket table on
+    every reservation.
+
+    Unpaid tickets stay in reserved until they're released, either by the
+    expiretickets command or when a type looks full.
+    """
+    __tablename__ = 'ticket_stock'
+    type_id = db.Column(db.Integer, db.ForeignKey('ticket_type.id'), primary_key=True)
+    reserved = db.Column(db.Integer, nullable=False, default=0)
+    paid = db.Column(db.Integer, nullable=False, default=0)
+    type = db.relationship(TicketType, backref=db.backref('stock', uselist=False))
+
+    def __init__(self, type_id, reserved=0, paid=0):
+        self.type_id = type_id
+        self.reserved = reserved
+        self.paid = paid
+
+    @property
+    def allocated(self):
+        return self.reserved + self.paid
+
+    @classmethod
+    def count(cls, type_ids=None):
+        """
+        Count tickets from the ticket table, returning {type_id: (reserved, paid)}
+        """
+        q = db.session.query(Ticket.type_id, Ticket.paid, Ticket.released, func.count(Ticket.id)). \
+            group_by(Ticket.type_id, Ticket.paid, Ticket.released)
+        if type_ids is not None:
+            q = q.filter(Ticket.type_id.in_(type_ids))
+
+        counts = {}
+        for type_id, paid, released, count in q:
+            reserved, paid_count = counts.get(type_id, (0, 0))
+            if paid:
+                paid_count += count
+            elif not released:
+                reserved += count
+            counts[type_id] = (reserved, paid_count)
+        return counts
+
+    def __repr__(self):
+        return "<TicketStock: type %s, reserved %s, paid %s>" % (self.type_id, self.reserved, self.paid)
+
+
+def committed(ticket, attr):
+    hist = attributes.get_history(ticket, attr)
+    return bool((hist.unchanged or hist.deleted or [False])[0])
+
+def holding(paid, released):
+    # which of the [added, reserved, paid] totals a ticket counts towards
+    if paid:
+        return 2
+    if not released:
+        return 1
+    return None
+
 @event.listens_for(Session, 'before_flush')
 def check_capacity(session, flush_context, instances):
-    totals = {}
+    # type_id -> [added, reserved delta, paid delta]
+    deltas = {}
 
     for obj in session.new:
         if not isinstance(obj, Ticket):
             continue
+        delta = deltas.setdefault(obj.type_id, [0, 0, 0])
+        delta[0] += 1
+        delta[holding(obj.paid, obj.released)] += 1
+
+    for obj in session.dirty:
+        if not isinstance(obj, Ticket):
+            continue
+        was = holding(committed(obj, 'paid'), committed(obj, 'released'))
+        now = holding(obj.paid, obj.released)
+        if was == now:
+            continue
+        delta = deltas.setdefault(obj.type_id, [0, 0, 0])
+        if was is not None:
+            delta[was] -= 1
+        else:
+            # a released ticket that's paid for late takes stock again
+            delta[0] += 1
+        if now is not None:
+            delta[now] += 1
+
+    for obj in session.deleted:
+        if not isinstance(obj, Ticket):
+            continue
+        was = holding(committed(obj, 'paid'), committed(obj, 'released'))
+        if was is not None:
+            delta = deltas.setdefault(obj.type_id, [0, 0, 0])
+            delta[was] -= 1
+
+    for type_id, (added, reserved, paid) in deltas.items():
+        take_stock(session, type_id, added, reserved, paid)
+
+def take_stock(session, type_id, added, reserved, paid):
+    """
+    Adjust the running totals for a ticket type, refusing if that would
+    put more than capacity tickets out.
+    """
+    q = session.query(TicketStock).filter_by(type_id=type_id)
+    if added:
+        type = ticket_types.get(type_id)
+        q = q.filter(TicketStock.reserved + TicketStock.paid + added <= type.capacity)
+
+    # A single conditional UPDATE both checks and takes the stock, and
+    # holds the row (or on SQLite, the database) until we commit.
+    updated = q.update({
+        TicketStock.reserved: TicketStock.reserved + reserved,
+        TicketStock.paid: TicketStock.paid + paid,
+    }, synchronize_session=False)
+
+    key = class_mapper(TicketStock).identity_key_from_primary_key([type_id])
+    stock = session.identity_map.get(key)
+    if updated:
+        if stock is not None:
+            session.expire(stock, ['reserved', 'paid'])
+        return
+
+    if added:
+        # Usually the type's just full. Only lock and recount if we've never
+        # counted it, or it has expired reservations a recount would free.
+        counted, expired = session.query(
+            exists().where(TicketStock.type_id == type_id),
+            exists().where(and_(Ticket.type_id == type_id, Ticket.paid == False,
+                                Ticket.released == False, Ticket.expires < datetime.utcnow())),
+        ).one()
+        if counted and not expired:
+            raise TicketError('No more tickets of type %s available' % type.name)
+
+    # Either we've never counted this type, or the running total
+    # includes reservations that have since expired.
+    stock, released = release_expired(session, type_id)
+
+    if added and stock.allocated + added > type.capacity:
+        raise TicketError('No more tickets of type %s available' % type.name)
+
+    stock.reserved += reserved
+    stock.paid += paid
+
+def release_expired(session, type_id, ids=None):
+    """
+    Release the expired, unpaid tickets of a type (or just those in ids)
+    so they stop counting against capacity, and recount its stock.
+
+    Locks the stock row first, in the same order as take_stock, and
+    leaves it locked until the caller commits. Returns (stock, released).
+    """
+    stock = session.query(TicketStock).filter_by(type_id=type_id). \
+        with_lockmode('update').populate_existing().first()
+
+    now = datetime.utcnow()
+    if ids is not None:
+        ids = list(ids)
+    q = session.query(Ticket).filter_by(type_id=type_id, paid=False, released=False). \
+        filter(Ticket.expires < now)
+    if ids is None:
+        released = q.update({Ticket.released: True}, synchronize_session=False)
+    else:
+        released = 0
+        # keep well under SQLite's limit on bound parameters
+        for i in range(0, len(ids), 500):
+            released += q.filter(Ticket.id.in_(ids[i:i + 500])). \
+                update({Ticket.released: True}, synchronize_session=False)
+
+    if released:
+        # bring any tickets we've already loaded into line with the UPDATE
+        wanted = set(ids or [])
+        for obj in session.identity_map.values():
+            if isinstance(obj, Ticket) and obj.type_id == type_id \
+                    and not committed(obj, 'paid') and not committed(obj, 'released') \
+                    and obj.expires < now and (ids is None or obj.id in wanted):
+                attributes.set_committed_value(obj, 'released', True)
+
+    counted = TicketStock.count([type_id]).get(type_id, (0, 0))
+    if stock is None:
+        stock = TicketStock(type_id, *counted)
+        session.add(stock)
+    else:
+        stock.reserved, stock.paid = counted
+
+    return stock, released
+
+def check_retake(session, tickets):
+    """
+    Check there's still room for any released tickets among tickets to be
+    paid for, raising TicketError if not. The stock rows stay locked until
+    the caller commits, so flush the tickets before checking more.
+    """
+    counts = {}
+    for t in tickets:
+        if t.released and not t.paid:
+            counts[t.type_id] = counts.get(t.type_id, 0) + 1
+    for type_id, count in counts.items():
+        take_stock(session, type_id, count, 0, 0)
+
+def expired_tickets(limit):
+    """
+    Find up to limit expired, unpaid tickets that still hold stock,
+    returning {type_id: [ticket ids]}.
+    """
+    q = db.session.query(Ticket.id, Ticket.type_id). \
+        filter_by(released=False, paid=False). \
+        filter(Ticket.expires < datetime.utcnow()). \
+        order_by(Ticket.expires).limit(limit)
+
+    ids = {}
+    for id, type_id in q:
+        ids.setdefault(type_id, []).append(id)
+    return ids
+
+@event.listens_for(Session, 'before_flush')
+def bump_ticket_types(session, flush_context, instances):
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, TicketType):
+            CacheVersion.bump('ticket_type')
+            # the new version can't be seen until it's committed
+            ticket_types.expire_on_commit = True
+            break
+
+@event.listens_for(Session, 'after_commit')
+def reload_ticket_types(session):
+    if ticket_types.expire_on_commit:
+        ticket_types.expire_on_commit = False
+        ticket_types.expire()
+
+def reserve_tickets(user, type, count, payment=None, expires=None, attempts=5):
+    """
+    Reserve count tickets of type for user, optionally against a payment,
+    and commit. Raises TicketError if the type is sold out or the user
+    would go over their limit.
 
-        if obj.type not in totals:
-            totals[obj.type] = Ticket.query.filter_by(type=obj.type). \
-                filter(or_(Ticket.expires >= datetime.utcnow(), Ticket.paid)). \
-                count()
+    The stock row stays locked from take_stock's UPDATE until the
+    commit, so the limit check can't race with another worker. Lock
+    timeouts and deadlocks are retried.
+    """
+    for attempt in range(attempts):
+        try:
+            return _reserve_tickets(user, type, count, payment, expires)
+        except OperationalError, e:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+        except TicketError:
+            db.session.rollback()
+            raise
 
-        totals[obj.type] += 1
+def _reserve_tickets(user, type, count, payment, expires):
+    if payment is not None:
+        user.payments.append(payment)
+        db.session.flush()
 
-    for type, count in totals.items():
+    Ticket.issue(type, [user.id] * count, payment=payment, expires=expires)
 
-        if count > type.capacity:
-            raise TicketError('No more tickets of type %s available') % type.name
+    held = Ticket.query.filter_by(user_id=user.id, type_id=type.id). \
+        filter(Ticket.expires >= datetime.utcnow()). \
+        count()
+    if held > type.limit:
+        raise TicketError('You can only buy %s tickets in total' % type.limit)
 
+    db.session.commit()
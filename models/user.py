@@ -1,10 +1,50 @@
-from main import db
+from main import app, db
+from models.cache import CacheVersion
+from sqlalchemy import event, case
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+import hitcounter
 import bcrypt
 import flaskext
 import os
 import base64
+import Queue
+import threading
+import time
 from datetime import datetime, timedelta
 
+class HashingBusy(Exception):
+    pass
+
+class HashSlots(object):
+    """
+    Limits how many bcrypt hashes run at once in this process, so a burst
+    of logins can only use PASSWORD_HASH_SLOTS cores per worker process
+    and leaves the rest for checkouts. Callers wait up to
+    PASSWORD_HASH_WAIT seconds for a slot, which holds their worker
+    thread, and then get HashingBusy rather than piling up.
+    """
+    def __init__(self, size):
+        self.slots = Queue.Queue()
+        for i in range(size):
+            self.slots.put(i)
+
+    def hashpw(self, password, salt):
+        try:
+            slot = self.slots.get(timeout=app.config.get('PASSWORD_HASH_WAIT', 0.5))
+        except Queue.Empty:
+            raise HashingBusy()
+        try:
+            return bcrypt.hashpw(password, salt)
+        finally:
+            self.slots.put(slot)
+
+hash_slots = HashSlots(app.config.get('PASSWORD_HASH_SLOTS', 2))
+
+def log_rounds():
+    # bcrypt's own default is 12
+    return app.config.get('BCRYPT_LOG_ROUNDS', 12)
+
 class User(db.Model, flaskext.login.UserMixin):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
@@ -20,10 +60,124 @@ class User(db.Model, flaskext.login.UserMixin):
         self.name = name
 
     def set_password(self, password):
-        self.password = bcrypt.hashpw(password.encode('utf8'), bcrypt.gensalt())
+        self.password = hash_slots.hashpw(password.encode('utf8'), bcrypt.gensalt(log_rounds()))
 
     def check_password(self, password):
-        return bcrypt.hashpw(password.encode('utf8'), self.password) == self.password
+        return hash_slots.hashpw(password.encode('utf8'), self.password) == self.password
+
+    def needs_rehash(self):
+        # hashes look like $2a$12$<salt and hash>
+        return int(self.password.split('$')[2]) != log_rounds()
+
+    @classmethod
+    def set_admin(cls, changes):
+        """
+        Set admin for many users in one UPDATE, from {user id: admin}.
+        """
+        if not changes:
+            return
+        whens = [(cls.id == id, admin) for id, admin in changes.items()]
+        cls.query.filter(cls.id.in_(changes.keys())). \
+            update({cls.admin: case(whens, else_=cls.admin)}, synchronize_session=False)
+        # a bulk update skips bump_users
+        CacheVersion.bump('user')
+        for id in changes:
+            user_cache.expire(id)
+
+class LoginFailure(db.Model):
+    """
+    A failed login, recorded once against the client IP and once against
+    the email address tried. See throttle.py.
+    """
+    __tablename__ = 'login_failure'
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String, nullable=False)
+    time = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        # recent failures for a key
+        db.Index('ix_login_failure_key_time', 'key', 'time'),
+    )
+
+    def __init__(self, key, time=None):
+        self.key = key
+        self.time = time or datetime.utcnow()
+
+    @classmethod
+    def clean(cls, before):
+        """
+        Delete failures from before before, returning how many. Doesn't commit.
+        """
+        return cls.query.filter(cls.time < before).delete(synchronize_session=False)
+
+class UserCache(object):
+    """
+    Users for the login manager, so that working out who's logged in
+    doesn't cost a query on every request.
+
+    Holds detached User objects, which are merged into the request's
+    session without loading. Any change to a user bumps the user cache
+    version, and every USER_CACHE_TTL seconds we check it and drop
+    everything if another process has changed a user.
+    """
+    # start again rather than grow without bound
+    max_size = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+        self.version = None
+        self.checked = 0
+        self.counter = hitcounter.hit_counter('user')
+
+    def refresh(self):
+        ttl = app.config.get('USER_CACHE_TTL', 30)
+        with self.lock:
+            if time.time() - self.checked < ttl:
+                return
+            version = CacheVersion.get('user')
+            if version != self.version:
+                self.users = {}
+                self.version = version
+            self.checked = time.time()
+
+    def expire(self, id=None):
+        with self.lock:
+            self.users.pop(id, None)
+            self.checked = 0
+
+    def get(self, id):
+        self.refresh()
+        with self.lock:
+            user = self.users.get(id)
+        if user is not None:
+            self.counter.hit()
+            return db.session.merge(user, load=False)
+
+        self.counter.miss()
+        if identity_key(User, [id]) in db.session.identity_map:
+            # the request's already loaded it, so leave that one alone
+            return User.query.get(id)
+        user = User.query.get(id)
+        if user is None:
+            return None
+        # keep our own copy, so the cached one never has changes pending
+        db.session.expunge(user)
+        with self.lock:
+            if len(self.users) >= self.max_size:
+                self.users = {}
+            self.users[id] = user
+        return db.session.merge(user, load=False)
+
+user_cache = UserCache()
+
+@event.listens_for(Session, 'before_flush')
+def bump_users(session, flush_context, instances):
+    changed = [obj for obj in session.dirty | session.deleted if isinstance(obj, User)
+               and (obj in session.deleted or session.is_modified(obj, include_collections=False))]
+    if changed:
+        CacheVersion.bump('user')
+        for user in changed:
+            user_cache.expire(user.id)
 
 class PasswordReset(db.Model):
     __tablename__ = 'password_reset'
@@ -31,6 +185,9 @@ class PasswordReset(db.Model):
     email = db.Column(db.String, nullable=False)
     expires = db.Column(db.DateTime, nullable=False)
     token = db.Column(db.String, nullable=False)
+    __table_args__ = (
+        db.Index('ix_password_reset_email_token', 'email', 'token'),
+    )
 
     def __init__(self, email):
         self.email = email
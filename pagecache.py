@@ -0,0 +1,114 @@
+"""
+Caching of rendered pages and fragments that don't depend on the user.
+
+Views decorated with @cached_page serve anonymous GETs from memory,
+rendering only on the first hit. Responses carry an ETag and
+Last-Modified, so browsers revalidating get a 304 without a body.
+Logged-in users, and anyone with a flashed message waiting, always get
+a fresh render.
+
+cached_include() does the same for static template fragments, which
+can then be shared by pages that are rendered per user.
+
+Everything is thrown away when a template changes or the config does,
+which we check every PAGE_CACHE_TTL seconds.
+"""
+from main import app
+from flask import request, session, render_template, make_response
+from flaskext.login import current_user
+from jinja2 import Markup
+from decorator import decorator
+from datetime import datetime
+import hashlib
+import os
+import threading
+import time
+
+class CachedPage(object):
+    def __init__(self, response):
+        self.data = response.data
+        self.status = response.status_code
+        self.mimetype = response.mimetype
+        self.etag = hashlib.md5(self.data).hexdigest()
+        self.last_modified = datetime.utcnow().replace(microsecond=0)
+
+    def response(self):
+        resp = app.response_class(self.data, self.status, mimetype=self.mimetype)
+        resp.set_etag(self.etag)
+        resp.last_modified = self.last_modified
+        return resp
+
+class PageCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.fragments = {}
+        self.version = None
+        self.checked = 0
+
+    def current_version(self):
+        mtimes = []
+        for path, dirs, files in os.walk(os.path.join(app.root_path, app.template_folder)):
+            mtimes.extend(os.path.getmtime(os.path.join(path, f)) for f in files)
+        config = hashlib.md5(repr(sorted(app.config.items()))).hexdigest()
+        return max(mtimes or [0]), config
+
+    def refresh(self):
+        ttl = app.config.get('PAGE_CACHE_TTL', 10)
+        with self.lock:
+            if time.time() - self.checked < ttl:
+                return
+            version = self.current_version()
+            if version != self.version:
+                self.pages = {}
+                self.fragments = {}
+                self.version = version
+            self.checked = time.time()
+
+    def expire(self):
+        self.checked = 0
+
+    def page(self, key, render):
+        self.refresh()
+        with self.lock:
+            page = self.pages.get(key)
+        if page is None:
+            response = make_response(render())
+            if response.status_code != 200:
+                return response
+            page = CachedPage(response)
+            with self.lock:
+                self.pages[key] = page
+        return page.response()
+
+    def fragment(self, name):
+        self.refresh()
+        with self.lock:
+            fragment = self.fragments.get(name)
+        if fragment is None:
+            fragment = Markup(render_template(name))
+            with self.lock:
+                self.fragments[name] = fragment
+        return fragment
+
+page_cache = PageCache()
+
+def cacheable():
+    return request.method == 'GET' and not current_user.is_authenticated() \
+        and '_flashes' not in session
+
+def cached_page(f):
+    def call(f, *args, **kw):
+        if not cacheable():
+            return f(*args, **kw)
+        # the views we cache ignore the query string, so ?utm_source=... shares the page
+        response = page_cache.page(request.path, lambda: f(*args, **kw))
+        response.headers['Vary'] = 'Cookie'
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    return decorator(call, f)
+
+@app.context_processor
+def fragment_processor():
+    # for fragments that are the same for everyone; they're rendered once
+    return dict(cached_include=page_cache.fragment)
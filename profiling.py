@@ -0,0 +1,152 @@
+"""
+Opt-in request instrumentation, turned on with PROFILING=True.
+
+Records wall time, SQL query count and time, and template render time
+for every request, and keeps the last PROFILING_WINDOW requests for
+each endpoint so /admin/profile can show percentiles. The page also
+shows the hit rates of the in-process caches, from hitcounter.py.
+
+Mail isn't timed, as requests only queue it; see the sendmail command.
+
+With PROFILING_DUMP_DIR set, each request also runs under cProfile, and
+those taking longer than PROFILING_DUMP_THRESHOLD seconds have their
+profile written there for pstats or snakeviz.
+"""
+from flask import g, request, _request_ctx_stack
+from jinja2 import Template
+from sqlalchemy import event
+from collections import deque
+import cProfile
+import os
+import threading
+import time
+
+FIELDS = ('wall', 'sql_count', 'sql_time', 'template_time')
+PERCENTILES = (50, 95, 99)
+
+class RequestTimings(object):
+    def __init__(self):
+        self.start = time.time()
+        self.sql_start = None
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+
+def current():
+    # None outside a request, e.g. in utils.py commands
+    if _request_ctx_stack.top is None:
+        return None
+    return getattr(g, 'timings', None)
+
+def percentile(values, p):
+    # nearest rank, on already sorted values
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class EndpointStats(object):
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+
+    def add(self, endpoint, sample):
+        with self.lock:
+            if endpoint not in self.samples:
+                self.samples[endpoint] = deque(maxlen=self.window)
+                self.counts[endpoint] = 0
+            self.samples[endpoint].append(sample)
+            self.counts[endpoint] += 1
+
+    def summary(self):
+        with self.lock:
+            samples = dict((e, list(s)) for e, s in self.samples.items())
+            counts = dict(self.counts)
+
+        endpoints = []
+        for endpoint in sorted(samples):
+            row = {'endpoint': endpoint, 'requests': counts[endpoint], 'window': len(samples[endpoint])}
+            for i, field in enumerate(FIELDS):
+                values = sorted(s[i] for s in samples[endpoint])
+                row[field] = dict(('p%d' % p, percentile(values, p)) for p in PERCENTILES)
+            endpoints.append(row)
+        return endpoints
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.counts = {}
+
+stats = EndpointStats()
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            timings = current()
+            if timings is not None:
+                timings.template_time += time.time() - start
+
+class ProfilerMiddleware(object):
+    """
+    Runs each request under cProfile, keeping the profile of slow ones.
+    """
+    def __init__(self, wsgi_app, dump_dir, threshold):
+        self.wsgi_app = wsgi_app
+        self.dump_dir = dump_dir
+        self.threshold = threshold
+
+    def __call__(self, environ, start_response):
+        profile = cProfile.Profile()
+        start = time.time()
+        response = profile.runcall(self.wsgi_app, environ, start_response)
+        elapsed = time.time() - start
+
+        if elapsed >= self.threshold:
+            endpoint = environ.get('emf.endpoint') or 'unknown'
+            filename = '%s-%s-%dms.prof' % (time.strftime('%Y%m%d-%H%M%S'), endpoint, elapsed * 1000)
+            profile.dump_stats(os.path.join(self.dump_dir, filename))
+        return response
+
+def setup(app, db):
+    stats.window = app.config.get('PROFILING_WINDOW', 1000)
+
+    @app.before_request
+    def start_timing():
+        g.timings = RequestTimings()
+        request.environ['emf.endpoint'] = request.endpoint
+
+    @app.teardown_request
+    def finish_timing(exc):
+        timings = current()
+        if timings is None:
+            return
+        g.timings = None
+        stats.add(request.endpoint or 'unknown', (time.time() - timings.start,
+            timings.sql_count, timings.sql_time, timings.template_time))
+
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        timings = current()
+        if timings is not None:
+            timings.sql_start = time.time()
+
+    @event.listens_for(db.engine, 'after_cursor_execute')
+    def finish_query(conn, cursor, statement, parameters, context, executemany):
+        timings = current()
+        if timings is not None and timings.sql_start is not None:
+            timings.sql_count += 1
+            timings.sql_time += time.time() - timings.sql_start
+            timings.sql_start = None
+
+    app.jinja_env.template_class = TimedTemplate
+
+    dump_dir = app.config.get('PROFILING_DUMP_DIR')
+    if dump_dir:
+        if not os.path.isdir(dump_dir):
+            os.makedirs(dump_dir)
+        app.wsgi_app = ProfilerMiddleware(app.wsgi_app, dump_dir,
+            app.config.get('PROFILING_DUMP_THRESHOLD', 1.0))
@@ -0,0 +1,121 @@
+"""
+Sales figures for /stats, which monitoring polls frequently.
+
+They're worked out with a couple of grouped queries, which the ticket
+and payment indexes keep cheap, and kept in memory for STATS_CACHE_TTL
+seconds so polling doesn't touch the database on every hit.
+
+Money figures are only for admins; public() leaves them out.
+"""
+from main import app, db
+from models.user import User
+from models.payment import Payment
+from models.ticket import Ticket, TicketType, ticket_types
+from sqlalchemy import func, distinct, or_
+from decimal import Decimal
+import threading
+import time
+
+class SalesStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = None
+        self.checked = 0
+
+    def get(self):
+        ttl = app.config.get('STATS_CACHE_TTL', 30)
+        with self.lock:
+            if self.stats is None or time.time() - self.checked >= ttl:
+                self.stats = self.count()
+                self.checked = time.time()
+            return self.stats
+
+    def expire(self):
+        self.checked = 0
+
+    def count(self):
+        types = {}
+        for t in ticket_types.all():
+            types[t.id] = {
+                'id': t.id,
+                'name': t.name,
+                'capacity': t.capacity,
+                'reserved': 0,
+                'paid': 0,
+                'expired': 0,
+                'users': 0,
+                'revenue': Decimal(0),
+                # unpaid tickets on payments we're waiting for
+                'awaiting_transfer': 0,
+                'awaiting_gocardless': 0,
+            }
+
+        q = db.session.query(Ticket.type_id, Ticket.paid, Ticket.released, Payment.provider, Payment.state,
+                func.count(Ticket.id)). \
+            outerjoin(Payment, Ticket.payment_id == Payment.id). \
+            group_by(Ticket.type_id, Ticket.paid, Ticket.released, Payment.provider, Payment.state)
+        for type_id, paid, released, provider, state, count in q:
+            counts = types.get(type_id)
+            if counts is None:
+                continue
+            if paid:
+                counts['paid'] += count
+            elif released:
+                counts['expired'] += count
+            else:
+                counts['reserved'] += count
+                if state == 'inprogress' and provider == 'banktransfer':
+                    counts['awaiting_transfer'] += count
+                elif state == 'inprogress' and provider == 'gocardless':
+                    counts['awaiting_gocardless'] += count
+
+        # tickets that are paid for or still held
+        q = db.session.query(Ticket.type_id, func.count(distinct(Ticket.user_id))). \
+            filter(or_(Ticket.paid == True, Ticket.released == False)). \
+            group_by(Ticket.type_id)
+        for type_id, users in q:
+            if type_id in types:
+                types[type_id]['users'] = users
+
+        for t in ticket_types.all():
+            types[t.id]['revenue'] = t.cost * types[t.id]['paid']
+
+        payments = {}
+        q = db.session.query(Payment.state, func.count(Payment.id), func.sum(Payment.amount_pence)). \
+            group_by(Payment.state)
+        for state, count, amount_pence in q:
+            payments[state] = {'count': count, 'amount': Decimal(amount_pence or 0) / 100}
+
+        return {
+            'users': User.query.count(),
+            'types': types.values(),
+            'payments': payments,
+            'generated': time.time(),
+        }
+
+    def public(self):
+        """
+        The figures without revenue or payment amounts, for anyone to see.
+        """
+        stats = self.get()
+        types = []
+        for t in stats['types']:
+            t = dict(t)
+            del t['revenue']
+            types.append(t)
+        payments = dict((state, {'count': p['count']}) for state, p in stats['payments'].items())
+        return dict(stats, types=types, payments=payments)
+
+    def summary(self):
+        """
+        The original /stats figures, which monitoring already graphs.
+        """
+        stats = self.get()
+        prepay = [t for t in stats['types'] if t['id'] == TicketType.Prepay.id][0]
+        return {
+            'prepays': prepay['awaiting_transfer'] + prepay['awaiting_gocardless'],
+            'users': stats['users'],
+            'prepays_bought': prepay['paid'],
+        }
+
+sales_stats = SalesStats()
@@ -0,0 +1,63 @@
+"""
+Throttling of failed logins, checked before any password is hashed.
+
+Failures are counted per client IP and per email address over the last
+LOGIN_THROTTLE_WINDOW seconds. Once either reaches its limit
+(LOGIN_FAILURES_PER_IP, LOGIN_FAILURES_PER_EMAIL), further attempts are
+turned away without touching bcrypt until old failures age out.
+
+The failures are kept in the database, so the limits are site-wide
+rather than per process. expiretickets deletes the ones that have aged out.
+"""
+from main import app, db
+from models.user import LoginFailure
+from sqlalchemy import func
+from datetime import datetime, timedelta
+
+class LoginThrottle(object):
+    def limits(self):
+        return {
+            'ip': app.config.get('LOGIN_FAILURES_PER_IP', 30),
+            'email': app.config.get('LOGIN_FAILURES_PER_EMAIL', 5),
+        }
+
+    def window(self):
+        return timedelta(seconds=app.config.get('LOGIN_THROTTLE_WINDOW', 300))
+
+    def keys(self, ip, email):
+        return {
+            'ip': 'ip:%s' % ip,
+            'email': 'email:%s' % (email or '').strip().lower(),
+        }
+
+    def blocked(self, ip, email):
+        keys = self.keys(ip, email)
+        since = datetime.utcnow() - self.window()
+        q = db.session.query(LoginFailure.key, func.count(LoginFailure.id)). \
+            filter(LoginFailure.key.in_(keys.values())). \
+            filter(LoginFailure.time > since). \
+            group_by(LoginFailure.key)
+        counts = dict(q)
+        limits = self.limits()
+        return any(counts.get(key, 0) >= limits[kind] for kind, key in keys.items())
+
+    def failed(self, ip, email):
+        now = datetime.utcnow()
+        for key in self.keys(ip, email).values():
+            db.session.add(LoginFailure(key, now))
+        db.session.commit()
+
+    def succeeded(self, ip, email):
+        # the IP keeps its count, as one address may be trying many accounts
+        LoginFailure.query.filter_by(key=self.keys(ip, email)['email']). \
+            delete(synchronize_session=False)
+        db.session.commit()
+
+    def clean(self):
+        """
+        Delete failures too old to count any more, returning how many.
+        Doesn't commit.
+        """
+        return LoginFailure.clean(datetime.utcnow() - self.window())
+
+login_throttle = LoginThrottle()
@@ -13,19 +13,165 @@ from sqlalchemy.orm.exc import NoResultFound
 from jinja2 import Environment, FileSystemLoader
 
 from decimal import Decimal
-import re, os
+import re, os, random, time, smtplib, socket, base64, urllib2, shutil, sqlite3, subprocess, tempfile
+import simplejson
+from gocardless.utils import generate_signature
+from sqlalchemy import event, func, create_engine
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.orm import joinedload
+from collections import namedtuple
+from datetime import datetime, timedelta
+from multiprocessing import Process, Queue
 
-from main import app, mail
-from models import User, TicketType
-from models.payment import Payment, BankPayment, safechars
+from main import app, mail, db
+from models import User, PasswordReset, TicketType, SchemaVersion
+from models.payment import Payment, PaymentChange, BankPayment, GoCardlessPayment, GoCardlessWebhook, BankTransaction, \
+  PaymentStateError, safechars, expire_payments, bankref_valid
+from models.ticket import Ticket, TicketStock, TicketError, reserve_tickets, release_expired, expired_tickets, \
+  check_retake
+from models.outbox import QueuedEmail
+from models.admission import QueueToken
+from migrations import migrate
+from views import mark_paid
+from throttle import login_throttle
+from flaskext.login import login_user
+import exports
 
 #app = Flask(__name__)
 #app.config.from_envvar('SETTINGS_FILE')
-db = SQLAlchemy(app)
-mail = Mail(app)
 
 manager = Manager(app)
 
+OfxTransaction = namedtuple('OfxTransaction', 'id type date amount payee memo')
+
+def ofx_date(value):
+  # DTPOSTED is YYYYMMDD, optionally followed by a time and timezone
+  if not value:
+    return None
+  return datetime.strptime(value[:8], '%Y%m%d')
+
+def ofx_transactions(f, chunk_size=65536):
+  """
+    Yield the transactions in an OFX statement one at a time, without
+    loading the whole file. Copes with SGML (unclosed tags) and XML OFX.
+  """
+  tag_re = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+  fields = None
+  buf = ''
+
+  while True:
+    data = f.read(chunk_size)
+    buf += data
+
+    # only parse up to the last complete tag's value
+    end = len(buf) if not data else buf.rfind('<')
+    pos = 0
+    for m in tag_re.finditer(buf, 0, end):
+      closing, tag, value = m.groups()
+      tag = tag.upper()
+      pos = m.end()
+      if tag == 'STMTTRN':
+        if closing and fields is not None:
+          yield OfxTransaction(fields.get('FITID'), fields.get('TRNTYPE', ''),
+            ofx_date(fields.get('DTPOSTED')), Decimal(fields.get('TRNAMT', '0')),
+            fields.get('NAME', ''), fields.get('MEMO', ''))
+          fields = None
+        elif not closing:
+          fields = {}
+      elif fields is not None and not closing:
+        fields[tag] = value.strip()
+
+    buf = buf[pos:]
+    if not data:
+      break
+
+bankref_re = re.compile('[%s]{4}-?[%s]{4}' % (safechars, safechars))
+loose_bankref_re = re.compile('[A-Z0-9]{4}-?[A-Z0-9]{4}')
+
+class BankrefIndex(object):
+  """
+    The bankrefs of all outstanding bank transfers, for matching
+    references that have been mistyped by one character. Expired transfers
+    count: a late payment can still retake its tickets if there's room.
+  """
+  # characters outside safechars that people (or OCR) use for one inside it
+  lookalikes = {'0': 'Q', 'O': 'Q', '1': 'T', 'I': 'T', 'L': '7', 'Z': '2',
+                'A': '4', 'E': '3', 'S': '9', '5': '6', 'U': 'V', 'N': 'M'}
+
+  def __init__(self, refs):
+    self.refs = set(refs)
+    # every ref with each position in turn blanked out, so a lookup finds
+    # all refs one substitution away
+    self.masked = {}
+    for ref in self.refs:
+      for key in self.masks(ref):
+        self.masked.setdefault(key, set()).add(ref)
+
+  # a mistyped ref has a character or two outside safechars, not a word's worth
+  max_lookalikes = 2
+
+  @classmethod
+  def ref_like(cls, token):
+    """
+      Whether token could be a ref with lookalikes typed for some of its
+      characters, rather than any 8 letters and digits, such as part of a
+      name or an account number.
+    """
+    outside = [c for c in token if c not in safechars]
+    if not outside:
+      return True
+    return all(c in cls.lookalikes for c in outside) and len(outside) <= cls.max_lookalikes
+
+  @classmethod
+  def outstanding(cls):
+    q = db.session.query(BankPayment.bankref).filter(BankPayment.state.in_(['inprogress', 'expired']))
+    return cls(r for (r,) in q)
+
+  @staticmethod
+  def masks(ref):
+    return [ref[:i] + '?' + ref[i + 1:] for i in range(len(ref))]
+
+  def candidates(self, token):
+    if token in self.refs:
+      return set([token])
+
+    found = set()
+    for key in self.masks(token):
+      found |= self.masked.get(key, set())
+    for i in range(len(token) - 1):
+      swapped = token[:i] + token[i + 1] + token[i] + token[i + 2:]
+      if swapped in self.refs:
+        found.add(swapped)
+    return found
+
+  def match(self, name):
+    """
+      Return the outstanding bankref that name most likely meant, or
+      None if there's no single close match.
+    """
+    found = set()
+    for token in loose_bankref_re.findall(name.upper()):
+      token = token.replace('-', '')
+      if not self.ref_like(token):
+        continue
+      token = ''.join(self.lookalikes.get(c, c) for c in token)
+      found |= self.candidates(token)
+
+    if len(found) == 1:
+      return found.pop()
+    return None
+
+  def propose(self, names):
+    """
+      Match many names at once, returning {name: bankref} for those that match
+    """
+    matches = {}
+    for name in names:
+      ref = self.match(name)
+      if ref:
+        matches[name] = ref
+    return matches
+
 class Reconcile(Command):
   """
     Reconcile transactions in a .ofx file against the emfcamp db
@@ -33,28 +179,62 @@ class Reconcile(Command):
   option_list = (Option('-f', '--file', dest='filename', help="The .ofx file to load"),
                  Option('-d', '--doit', action='store_true', help="set this to actually change the db"),
                  Option('-q', '--quiet', action='store_true', help="don't be verbose"),
+                 Option('-b', '--batch', dest='batch', type=int, default=0,
+                        help="stream the file and reconcile this many transactions per query and transaction"),
                 )
 
-  badrefs = []
-  alreadypaid = 0
-  paid = 0
-  tickets_paid = 0
-  ref_fixups = {}
-  overpays = {}
-
-  def run(self, filename, doit, quiet):
+  def setup(self, doit, quiet):
     self.doit = doit
     self.quiet = quiet
-    
+    self.badrefs = []
+    self.alreadypaid = 0
+    self.paid = 0
+    self.tickets_paid = 0
+    self.ref_fixups = {}
+    self.overpays = {}
+    self.fuzzy_matched = 0
+    self.failed_check = 0
+    self._index = None
+    self._legacy = None
+    self.new = 0
+    self.skipped = 0
+
     if os.path.exists("/etc/emf/reffixups.py"):
       sys.path.append("/etc/emf")
       import reffixups
       self.ref_fixups = reffixups.fixups
       self.overpays = reffixups.overpays
 
+  def run(self, filename, doit, quiet, batch):
+    self.setup(doit, quiet)
+
+    start = time.time()
+    if batch:
+      self.reconcile_stream(file(filename), batch)
+    else:
+      self.reconcile_file(filename)
+    elapsed = time.time() - start
+
+    if len(self.badrefs) > 0:
+      print
+      print "unmatched references:"
+      for r in self.badrefs:
+        print r
+    print
+    print "already paid: %d, payments paid this run: %d, tickets: %d, mistyped refs matched: %d" % \
+      (self.alreadypaid, self.paid, self.tickets_paid, self.fuzzy_matched)
+    print "refs with a wrong check character: %d" % self.failed_check
+    if self.new:
+      # assume the skipped ones would have cost what the new ones did
+      print "new transactions: %d, skipped from previous runs: %d (about %.1fs saved)" % \
+        (self.new, self.skipped, elapsed / self.new * self.skipped)
+    else:
+      print "new transactions: 0, skipped from previous runs: %d" % self.skipped
+
+  def reconcile_file(self, filename):
     data = ofxparse.OfxParser.parse(file(filename))
 
-    for t in data.account.statement.transactions:
+    for t in self.unseen(data.account.statement.transactions):
       # field mappings:
       # 
       # NAME 		: payee  <-- the ref we want
@@ -64,14 +244,51 @@ class Reconcile(Command):
       # TRNAMT		: amount <-- this is important...
       # DTPOSTED	: date   
       self.reconcile(t.payee, Decimal(t.amount), t)
-    
-    if len(self.badrefs) > 0:
-      print
-      print "unmatched references:"
-      for r in self.badrefs:
-        print r
-    print
-    print "already paid: %d, payments paid this run: %d, tickets: %d" % (self.alreadypaid, self.paid, self.tickets_paid)
+
+    if self.doit:
+      db.session.commit()
+
+  def unseen(self, txns):
+    """
+      Drop transactions that a previous run has already dealt with.
+    """
+    seen = BankTransaction.seen([t.id for t in txns])
+    new = []
+    for t in txns:
+      if t.id in seen:
+        self.skipped += 1
+        continue
+      if t.id:
+        # the same FITID twice in one batch would break the unique index
+        seen.add(t.id)
+      new.append(t)
+    self.new += len(new)
+    return new
+
+  def record(self, t, payment=None):
+    """
+      Add a transaction to the ledger so later runs skip it. Only
+      transactions we've finished with should be recorded.
+    """
+    if self.doit and t.id:
+      db.session.add(BankTransaction(t.id, t.date, Decimal(t.amount), t.payee, payment))
+
+  def find_refs(self, name):
+    ref = name.upper()
+    # looks like this is:
+    # NAME REF XXX
+    # where name may contain multiple chars, and XXX is a 3 letter code
+    # originating bank(?)
+    #
+    found = bankref_re.findall(ref)
+    refs = self.checked(f.replace('-', '') for f in found)
+    #
+    # some refs are missed typed so we have a list
+    # of fixes to make them match
+    #
+    if name in self.ref_fixups:
+      refs.append(self.ref_fixups[name])
+    return refs
 
   def find_payment(self, name):
     ref = name.upper()
@@ -80,9 +297,8 @@ class Reconcile(Command):
     # where name may contain multiple chars, and XXX is a 3 letter code
     # originating bank(?)
     #
-    found = re.findall('[%s]{4}-?[%s]{4}' % (safechars, safechars), ref)
-    for f in found:
-      bankref = f.replace('-', '')
+    found = bankref_re.findall(ref)
+    for bankref in self.checked(f.replace('-', '') for f in found):
       try:
         return BankPayment.query.filter_by(bankref=bankref).one()
       except NoResultFound:
@@ -94,8 +310,181 @@ class Reconcile(Command):
       #
       if name in self.ref_fixups:
         return BankPayment.query.filter_by(bankref=self.ref_fixups[name]).one()
+      bankref = self.index.match(name)
+      if bankref:
+        self.fuzzy(name, bankref)
+        return BankPayment.query.filter_by(bankref=bankref).one()
       raise ValueError('No matches found ', name)
 
+  def checked(self, refs):
+    """
+      Drop refs whose check character is wrong, without going to the db.
+      They're left for the mistyped ref matching.
+    """
+    ok = []
+    for ref in refs:
+      if bankref_valid(ref) or ref in self.legacy:
+        ok.append(ref)
+      else:
+        self.failed_check += 1
+    return ok
+
+  @property
+  def legacy(self):
+    # refs from before we had check characters, which mostly fail the check
+    if self._legacy is None:
+      q = db.session.query(BankPayment.bankref)
+      self._legacy = set(r for (r,) in q if r and not bankref_valid(r))
+    return self._legacy
+
+  @property
+  def index(self):
+    if self._index is None:
+      self._index = BankrefIndex.outstanding()
+    return self._index
+
+  def fuzzy(self, name, bankref):
+    self.fuzzy_matched += 1
+    if not self.quiet:
+      print "matched mistyped ref %s to %s" % (repr(name), bankref)
+
+  def reconcile_stream(self, f, batch):
+    txns = []
+    for t in ofx_transactions(f):
+      txns.append(t)
+      if len(txns) >= batch:
+        self.reconcile_batch(txns)
+        txns = []
+
+    if txns:
+      self.reconcile_batch(txns)
+
+  def reconcile_batch(self, txns):
+    """
+      Reconcile a list of transactions with one query for their payments
+      and one for their tickets, then commit them all together.
+    """
+    payins = []
+    for t in self.unseen(txns):
+      if t.type.lower() == 'other' or t.type.upper() == "DIRECTDEP":
+        payins.append(t)
+      else:
+        if not self.quiet:
+          print t, t.type, t.payee
+        self.record(t)
+    txns = payins
+
+    refs = [self.find_refs(t.payee) for t in txns]
+    payments = self.load_payments(set(r for rs in refs for r in rs))
+
+    # anything we couldn't find might be a typo for an outstanding ref
+    missing = [t.payee for t, rs in zip(txns, refs) if not any(r in payments for r in rs)]
+    proposed = self.index.propose(missing)
+    if proposed:
+      payments.update(self.load_payments(set(proposed.values())))
+      for t, rs in zip(txns, refs):
+        if t.payee in proposed and not any(r in payments for r in rs):
+          self.fuzzy(t.payee, proposed[t.payee])
+          rs.append(proposed[t.payee])
+
+    tickets = {}
+    ids = [p.id for p in payments.values()]
+    for i in range(0, len(ids), 500):
+      q = Ticket.query.filter(Ticket.payment_id.in_(ids[i:i + 500])). \
+        options(joinedload('type'))
+      for ticket in q:
+        tickets.setdefault(ticket.payment_id, []).append(ticket)
+
+    for t, rs in zip(txns, refs):
+      amount = Decimal(t.amount)
+      for r in rs:
+        if r in payments:
+          payment = payments[r]
+          if self.settle(t.payee, amount, payment, tickets.get(payment.id, [])):
+            self.record(t, payment)
+          break
+      else:
+        if not self.quiet:
+          print "Exception matching ref %s paid %d: %s" % (repr(t.payee), amount, 'No matches found')
+        self.badrefs.append([repr(t.payee), amount])
+
+    if self.doit:
+      db.session.commit()
+    else:
+      db.session.rollback()
+
+  def load_payments(self, bankrefs):
+    bankrefs = list(bankrefs)
+    payments = {}
+    # keep well under SQLite's limit on bound parameters
+    for i in range(0, len(bankrefs), 500):
+      q = BankPayment.query.filter(BankPayment.bankref.in_(bankrefs[i:i + 500])). \
+        options(joinedload('user'))
+      for p in q:
+        payments[p.bankref] = p
+    return payments
+
+  def settle(self, ref, amount, payment, tickets):
+    """
+      As reconcile, for a payment and tickets we've already loaded.
+      Queues the email rather than sending it, and doesn't commit.
+      Returns True if we're done with this transaction.
+    """
+    user = payment.user
+
+    if payment.state == "paid" and payment.amount == amount:
+      # all paid up, great lets ignore this one.
+      self.alreadypaid += 1
+      return True
+
+    total = Decimal(0)
+    for t in tickets:
+      if t.paid == False:
+        total += t.type.cost
+      elif not self.quiet:
+        if payment.id not in self.overpays:
+          print "attempt to pay for paid ticket: %d, user: %s, payment id: %d" % (t.id, user.name, payment.id)
+
+    if total == 0:
+      # nothing owed, so an old payment...
+      return True
+
+    if total != amount and payment.id not in self.overpays:
+      print "tried to reconcile payment %s for %s, but amount paid (%.2f) didn't match amount owed (%.2f)" % (ref, user.name, amount, total)
+      return False
+
+    # all paid up.
+    if not self.quiet:
+      print "user %s paid for %d (%.2f) tickets with ref: %s" % (user.name, len(tickets), amount, ref)
+
+    try:
+      # a late payment for released tickets only counts if there's still room
+      check_retake(db.session, tickets)
+      payment.set_state("paid")
+    except (TicketError, PaymentStateError), e:
+      print "tried to reconcile payment %s for %s: %s" % (ref, user.name, e)
+      return False
+
+    self.paid += 1
+    self.tickets_paid += len(tickets)
+
+    for t in tickets:
+      t.paid = True
+    if any(t.released for t in tickets):
+      # so the next check_retake sees these
+      db.session.flush()
+
+    msg = Message("Electromagnetic Field ticket purchase update", \
+                  sender=app.config.get('TICKETS_EMAIL'), \
+                  recipients=[user.email]
+                 )
+    msg.body = render_template("tickets-paid-email-banktransfer.txt", \
+                  basket={"count" : len(tickets), "reference" : payment.bankref}, \
+                  user = user, payment=payment
+                 )
+    db.session.add(QueuedEmail(msg))
+    return True
+
   def reconcile(self, ref, amount, t):
     if t.type.lower() == 'other' or t.type.upper() == "DIRECTDEP":
       try:
@@ -113,19 +502,21 @@ class Reconcile(Command):
         if payment.state == "paid" and (Decimal(payment.amount_pence) / 100) == amount:
           # all paid up, great lets ignore this one.
           self.alreadypaid += 1
+          self.record(t, payment)
           return
 
         unpaid = payment.tickets.all()
         total = Decimal(0)
-        for t in unpaid:
-          if t.paid == False:
-            total += Decimal(str(t.type.cost_pence / 100.0))
+        for ticket in unpaid:
+          if ticket.paid == False:
+            total += Decimal(str(ticket.type.cost_pence / 100.0))
           elif not self.quiet:
             if payment.id not in self.overpays:
-              print "attempt to pay for paid ticket: %d, user: %s, payment id: %d" % (t.id, payment.user.name, payment.id)
+              print "attempt to pay for paid ticket: %d, user: %s, payment id: %d" % (ticket.id, payment.user.name, payment.id)
 
         if total == 0:
           # nothing owed, so an old payment...
+          self.record(t, payment)
           return
           
         if total != amount and payment.id not in self.overpays:
@@ -135,15 +526,20 @@ class Reconcile(Command):
           if not self.quiet:
             print "user %s paid for %d (%.2f) tickets with ref: %s" % (user.name, len(unpaid), amount, ref)
           
-          self.paid += 1
-          self.tickets_paid += len(unpaid)
           if self.doit:
             # not sure why we have to do this, or why the object is already in a session.
             s = db.object_session(unpaid[0])
-            for t in unpaid:
-              t.paid = True
-            payment.state = "paid"
-            s.commit()
+            payment.set_state("paid")
+            for ticket in unpaid:
+              ticket.paid = True
+            self.record(t, payment)
+            try:
+              s.commit()
+            except TicketError, e:
+              # released tickets, and the type has sold out since
+              s.rollback()
+              print "tried to reconcile payment %s for %s: %s" % (ref, user.name, e)
+              return
             # send email
             # tickets-paid-email-banktransfer.txt
             msg = Message("Electromagnetic Field ticket purchase update", \
@@ -156,9 +552,13 @@ class Reconcile(Command):
                          )
             mail.send(msg)
 
+          self.paid += 1
+          self.tickets_paid += len(unpaid)
+
     else:
       if not self.quiet:
         print t, t.type, t.payee
+      self.record(t)
     
 
 class TestEmails(Command):
@@ -208,9 +608,807 @@ class CreateTickets(Command):
 
         print 'Tickets created'
 
+class CheckStock(Command):
+  """
+    Verify the running ticket totals against the ticket table
+  """
+  option_list = (Option('-f', '--fix', action='store_true', help="set this to rewrite totals that don't match"),
+                )
+
+  def run(self, fix):
+    counts = TicketStock.count()
+    bad = 0
+
+    for type in TicketType.query.order_by(TicketType.id):
+      reserved, paid = counts.get(type.id, (0, 0))
+      stock = type.stock
+      if stock is None:
+        print "%s: no running total, counted reserved %d, paid %d" % (type.name, reserved, paid)
+        if fix:
+          db.session.add(TicketStock(type.id, reserved, paid))
+        bad += 1
+      elif (stock.reserved, stock.paid) != (reserved, paid):
+        print "%s: running total reserved %d, paid %d, counted reserved %d, paid %d" % \
+          (type.name, stock.reserved, stock.paid, reserved, paid)
+        if fix:
+          stock.reserved, stock.paid = reserved, paid
+        bad += 1
+      else:
+        print "%s: reserved %d, paid %d, capacity %d" % (type.name, reserved, paid, type.capacity)
+
+    if fix:
+      db.session.commit()
+    print
+    print "%d ticket types out of step%s" % (bad, ", fixed" if fix and bad else "")
+
+class StressTest(Command):
+  """
+    Hammer ticket reservation from several processes at once and check
+    nothing is oversold. Only runs against SQLite, and cleans up after itself.
+
+    Each worker can hold up to 4 tickets, so capacity has to be below
+    4 * workers for the type to sell out; the run fails if it doesn't.
+  """
+  option_list = (Option('-w', '--workers', dest='workers', type=int, default=8, help="number of processes"),
+                 Option('-c', '--capacity', dest='capacity', type=int, default=20, help="tickets available"),
+                 Option('-n', '--attempts', dest='attempts', type=int, default=20, help="purchases per process"),
+                )
+
+  def run(self, workers, capacity, attempts):
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite:'):
+      print "refusing to stress test a non-SQLite database"
+      return 1
+
+    run_id = int(time.time())
+    type = TicketType('Stress test %d' % run_id, capacity, 4, 1)
+    db.session.add(type)
+    users = []
+    for i in range(workers):
+      user = User('stress-%d-%d@example.invalid' % (run_id, i), 'Stress test %d' % i)
+      user.password = '!'
+      db.session.add(user)
+      users.append(user)
+    db.session.commit()
+
+    type_id = type.id
+    user_ids = [u.id for u in users]
+
+    # don't share the parent's sqlite connections with the children
+    db.session.remove()
+    db.engine.dispose()
+
+    results = Queue()
+    procs = [Process(target=self.worker, args=(type_id, uid, attempts, results)) for uid in user_ids]
+    start = time.time()
+    for p in procs:
+      p.start()
+    for p in procs:
+      p.join()
+    elapsed = time.time() - start
+
+    reserved = sold_out = over_limit = failed = 0
+    for p in procs:
+      r, s, o, f = results.get()
+      reserved += r
+      sold_out += s
+      over_limit += o
+      failed += f
+
+    type = TicketType.query.get(type_id)
+    held = Ticket.query.filter_by(type_id=type_id).count()
+    per_user = [Ticket.query.filter_by(type_id=type_id, user_id=uid).count() for uid in user_ids]
+
+    print "%d workers, %d purchases each, %.2fs" % (workers, attempts, elapsed)
+    print "tickets reserved: %d, sold out: %d, over limit: %d, lock failures: %d" % (reserved, sold_out, over_limit, failed)
+    print "capacity: %d, tickets in db: %d, running total: %d, most held by one user: %d" % \
+      (capacity, held, type.stock.allocated, max(per_user))
+
+    ok = held <= capacity and held == reserved and type.stock.allocated == held and max(per_user) <= type.limit
+
+    for t in Ticket.query.filter_by(type_id=type_id):
+      db.session.delete(t)
+    for p in Payment.query.filter(Payment.user_id.in_(user_ids)):
+      db.session.delete(p)
+    for u in User.query.filter(User.id.in_(user_ids)):
+      db.session.delete(u)
+    db.session.delete(type.stock)
+    db.session.delete(type)
+    db.session.commit()
+
+    if not ok:
+      print "OVERSOLD"
+      return 1
+    if not sold_out:
+      print "never sold out, so the capacity check wasn't tested; use a capacity below %d" % (workers * 4)
+      return 1
+    print "OK"
+
+  def worker(self, type_id, user_id, attempts, results):
+    reserved = sold_out = over_limit = failed = 0
+    for i in range(attempts):
+      user = User.query.get(user_id)
+      type = TicketType.query.get(type_id)
+      count = random.randint(1, type.limit)
+      try:
+        reserve_tickets(user, type, count, BankPayment(type.cost * count))
+        reserved += count
+      except TicketError, e:
+        if 'available' in str(e):
+          sold_out += 1
+        else:
+          over_limit += 1
+      except Exception, e:
+        db.session.rollback()
+        failed += 1
+      db.session.remove()
+    results.put((reserved, sold_out, over_limit, failed))
+
+class SendEmail(Command):
+  """
+    Send queued emails over a single SMTP connection, retrying failures with backoff.
+    Only run one of these at a time.
+  """
+  option_list = (Option('-b', '--batch', dest='batch', type=int, default=100, help="emails per connection"),
+                 Option('-l', '--loop', action='store_true', help="keep running, checking the queue every few seconds"),
+                 Option('-s', '--sleep', dest='sleep', type=int, default=5, help="seconds between checks when looping"),
+                )
+
+  def run(self, batch, loop, sleep):
+    max_attempts = app.config.get('MAIL_QUEUE_ATTEMPTS', 8)
+
+    while True:
+      jobs = QueuedEmail.query.filter(QueuedEmail.sent == None). \
+        filter(QueuedEmail.next_attempt <= datetime.utcnow()). \
+        filter(QueuedEmail.attempts < max_attempts). \
+        order_by(QueuedEmail.id).limit(batch).all()
+
+      if jobs:
+        sent = self.send(jobs)
+        db.session.commit()
+        print "sent %d of %d queued emails" % (sent, len(jobs))
+
+      if not loop:
+        break
+      if len(jobs) < batch:
+        time.sleep(sleep)
+
+  def send(self, jobs):
+    sent = 0
+    try:
+      with mail.connect() as conn:
+        if conn.host is None and not conn.suppress:
+          # Flask-Mail swallows connection errors when MAIL_FAIL_SILENTLY is on
+          raise socket.error('Unable to connect to %s:%s' % (mail.server, mail.port))
+
+        for job in jobs:
+          try:
+            job.message().send(conn)
+          except (smtplib.SMTPServerDisconnected, socket.error):
+            raise
+          except Exception, e:
+            print "failed to send email %d: %s" % (job.id, e)
+            job.failed(e)
+          else:
+            job.sent = datetime.utcnow()
+            sent += 1
+
+    except (smtplib.SMTPException, socket.error), e:
+      # the connection's gone, so try everything left again later
+      print "lost connection to mail server: %s" % e
+      for job in jobs:
+        if job.sent is None:
+          job.failed(e)
+
+    return sent
+
+class ProcessWebhooks(Command):
+  """
+    Process stored GoCardless webhooks, one transaction per payload
+  """
+  option_list = (Option('-l', '--loop', action='store_true', help="keep running, checking for new webhooks every few seconds"),
+                 Option('-s', '--sleep', dest='sleep', type=int, default=2, help="seconds between checks when looping"),
+                )
+
+  def run(self, loop, sleep):
+    while True:
+      hooks = GoCardlessWebhook.query.filter(GoCardlessWebhook.processed == None). \
+        filter(GoCardlessWebhook.error == None). \
+        order_by(GoCardlessWebhook.id).all()
+
+      for hook in hooks:
+        process_webhook(hook)
+
+      if not loop:
+        break
+      if not hooks:
+        time.sleep(sleep)
+
+def process_webhook(hook):
+  try:
+    hook.process()
+    db.session.commit()
+    print "processed webhook %d" % hook.id
+  except Exception, e:
+    db.session.rollback()
+    app.logger.exception("Error processing webhook %d", hook.id)
+    hook.error = str(e)
+    db.session.commit()
+    print "error processing webhook %d: %s" % (hook.id, e)
+
+class ReplayWebhooks(Command):
+  """
+    Process stored GoCardless webhooks again. Payments that are already paid are left alone.
+  """
+  option_list = (Option('-i', '--id', dest='ids', type=int, action='append', help="webhook to replay, can be given more than once"),
+                 Option('-f', '--failed', action='store_true', help="replay all webhooks that failed"),
+                 Option('-a', '--all', action='store_true', help="replay every stored webhook"),
+                )
+
+  def run(self, ids, failed, all):
+    q = GoCardlessWebhook.query.order_by(GoCardlessWebhook.id)
+    if ids:
+      q = q.filter(GoCardlessWebhook.id.in_(ids))
+    elif failed:
+      q = q.filter(GoCardlessWebhook.error != None)
+    elif not all:
+      print "nothing to replay, give -i, -f or -a"
+      return 1
+
+    for hook in q.all():
+      process_webhook(hook)
+
+def signed_webhook(gcids, action):
+  """
+    A bill webhook body for gcids, signed as GoCardless would sign it
+  """
+  payload = {
+    'resource_type': 'bill',
+    'action': action,
+    'bills': [{'id': gcid, 'status': action, 'source_type': 'ad_hoc_authorization',
+               'source_id': 'SYNTHETIC', 'uri': 'https://example.invalid/api/v1/bills/%s' % gcid}
+              for gcid in gcids],
+    # make each call a distinct event
+    'nonce': base64.b64encode(os.urandom(12)),
+  }
+  payload['signature'] = generate_signature(payload, app.config['GOCARDLESS_APP_SECRET'])
+  return simplejson.dumps({'payload': payload})
+
+class FireWebhook(Command):
+  """
+    Send a signed synthetic bill webhook to a running copy of the site
+  """
+  option_list = (Option('-u', '--url', dest='url', default='http://localhost:5000/gocardless-webhook', help="webhook URL"),
+                 Option('-a', '--action', dest='action', default='paid', help="bill action (paid, failed, withdrawn, created)"),
+                 Option('-g', '--gcid', dest='gcids', action='append', help="GoCardless bill id, can be given more than once"),
+                 Option('-r', '--repeat', dest='repeat', type=int, default=1, help="deliver the same payload this many times"),
+                )
+
+  def run(self, url, action, gcids, repeat):
+    if not gcids:
+      gcids = [p.gcid for p in GoCardlessPayment.query.filter_by(state='inprogress')]
+      print "firing for %d inprogress payments" % len(gcids)
+
+    body = signed_webhook(gcids, action)
+
+    for i in range(repeat):
+      start = time.time()
+      try:
+        resp = urllib2.urlopen(urllib2.Request(url, body, {'Content-Type': 'application/json'}))
+        status = resp.getcode()
+      except urllib2.HTTPError, e:
+        status = e.code
+      print "%s: %d in %.3fs" % (url, status, time.time() - start)
+
+class QueryBudget(Command):
+  """
+    Check that the tickets page runs a fixed number of queries however
+    many tickets and payments a user has
+  """
+  option_list = (Option('-b', '--budget', dest='budget', type=int, default=3, help="most queries allowed per page view"),
+                )
+
+  def run(self, budget):
+    user = User('querybudget-%d@example.invalid' % time.time(), 'Query budget')
+    user.password = '!'
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+
+    app.config['PAYMENTS'] = True
+    client = app.test_client()
+    with client.session_transaction() as sess:
+      sess['user_id'] = user_id
+
+    statements = []
+    counting = [True]
+    def count(conn, cursor, statement, parameters, context, executemany):
+      if counting[0]:
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', count)
+
+    ok = True
+    try:
+      # the first view warms up the per-process caches
+      client.get('/tickets')
+
+      for size in (1, 4, 20):
+        self.add_payments(user_id, size)
+
+        del statements[:]
+        resp = client.get('/tickets')
+        print "%d payments: %d queries, status %d" % (size, len(statements), resp.status_code)
+        if len(statements) > budget or resp.status_code != 200:
+          ok = False
+          for statement in statements:
+            print "  ", statement.replace('\n', ' ')
+    finally:
+      counting[0] = False
+      db.session.remove()
+      user = User.query.get(user_id)
+      for p in user.payments:
+        db.session.delete(p)
+      db.session.delete(user)
+      db.session.commit()
+
+    if not ok:
+      print "over budget of %d queries" % budget
+      return 1
+    print "OK"
+
+  def add_payments(self, user_id, count):
+    user = User.query.get(user_id)
+    prepay = TicketType.query.filter_by(name='Prepay Camp Ticket').one()
+    for i in range(count):
+      payment = BankPayment(prepay.cost)
+      payment.set_state('inprogress')
+      user.payments.append(payment)
+      ticket = Ticket(type=prepay)
+      ticket.payment = payment
+      user.tickets.append(ticket)
+    db.session.commit()
+
+class CheckOversell(Command):
+  """
+    Check that paying late for released tickets can't take a ticket type
+    over capacity, through the manual reconcile page or reconcile. Uses a
+    throwaway ticket type with room for one ticket.
+  """
+
+  def run(self):
+    run_id = int(time.time())
+    type = TicketType('Oversell check %d' % run_id, 1, 2, Decimal('10.00'))
+    late = User('oversell-late-%d@example.invalid' % run_id, 'Late payer')
+    late.password = '!'
+    other = User('oversell-other-%d@example.invalid' % run_id, 'Other buyer')
+    other.password = '!'
+    db.session.add_all([type, late, other])
+    db.session.commit()
+    type_id, user_ids = type.id, [late.id, other.id]
+
+    ok = True
+    try:
+      # the late payer's ticket is released, and someone else buys the last one
+      payment = BankPayment(type.cost)
+      reserve_tickets(late, type, 1, payment=payment)
+      payment.set_state('inprogress')
+      ticket = payment.tickets.one()
+      ticket.expires = datetime.utcnow() - timedelta(days=1)
+      db.session.commit()
+      release_expired(db.session, type_id)
+      payment.set_state('expired')
+      db.session.commit()
+      reserve_tickets(other, type, 1)
+      payment_id = payment.id
+
+      with app.test_request_context():
+        login_user(User.query.get(user_ids[0]))
+        try:
+          mark_paid([payment_id])
+          db.session.commit()
+          print "manual reconcile: sold more than capacity"
+          ok = False
+        except TicketError:
+          db.session.rollback()
+          print "manual reconcile: refused"
+
+      r = Reconcile()
+      r.setup(True, True)
+      payment = BankPayment.query.get(payment_id)
+      if r.settle(payment.bankref, payment.amount, payment, payment.tickets.all()):
+        print "reconcile: sold more than capacity"
+        ok = False
+      else:
+        print "reconcile: refused"
+      db.session.commit()
+
+      payment = BankPayment.query.get(payment_id)
+      stock = TicketStock.query.get(type_id)
+      counted = TicketStock.count([type_id]).get(type_id, (0, 0))
+      if payment.state != 'expired' or payment.tickets.filter_by(paid=True).count():
+        print "payment %s was changed: %s" % (payment_id, payment.state)
+        ok = False
+      if (stock.reserved, stock.paid) != counted or stock.allocated > 1:
+        print "stock is reserved %d, paid %d, but tickets say %d, %d" % \
+          ((stock.reserved, stock.paid) + counted)
+        ok = False
+    finally:
+      db.session.rollback()
+      Ticket.query.filter(Ticket.user_id.in_(user_ids)).delete(synchronize_session=False)
+      payment_ids = [id for (id,) in db.session.query(Payment.id).filter(Payment.user_id.in_(user_ids))]
+      if payment_ids:
+        PaymentChange.query.filter(PaymentChange.payment_id.in_(payment_ids)).delete(synchronize_session=False)
+      Payment.query.filter(Payment.user_id.in_(user_ids)).delete(synchronize_session=False)
+      User.query.filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+      TicketStock.query.filter_by(type_id=type_id).delete(synchronize_session=False)
+      db.session.delete(TicketType.query.get(type_id))
+      db.session.commit()
+
+    if not ok:
+      return 1
+    print "OK"
+
+class ExpireTickets(Command):
+  """
+    Release unpaid tickets that have expired, so they stop holding stock,
+    and mark payments expired once none of their tickets are held. Also
+    clears out old waiting room tokens and login failures. Safe to run
+    from cron while the site is up.
+  """
+  option_list = (Option('-b', '--batch', dest='batch', type=int, default=500, help="tickets or payments per transaction"),
+                 Option('-l', '--loop', action='store_true', help="keep running, checking every few seconds"),
+                 Option('-s', '--sleep', dest='sleep', type=int, default=60, help="seconds between checks when looping"),
+                )
+
+  def run(self, batch, loop, sleep):
+    while True:
+      released = 0
+      while True:
+        ids = expired_tickets(batch)
+        count = 0
+        for type_id in sorted(ids):
+          stock, n = release_expired(db.session, type_id, ids[type_id])
+          count += n
+        db.session.commit()
+        released += count
+        if count < batch:
+          break
+
+      expired = 0
+      while True:
+        payments = expire_payments(batch)
+        db.session.commit()
+        expired += len(payments)
+        if len(payments) < batch:
+          break
+
+      age = timedelta(seconds=app.config.get('WAITING_ROOM_TOKEN_AGE', 86400))
+      cleaned = QueueToken.clean(datetime.utcnow() - age)
+      failures = login_throttle.clean()
+      db.session.commit()
+
+      if released or expired:
+        print "released %d tickets, expired %d payments" % (released, expired)
+      if cleaned:
+        print "deleted %d old queue tokens" % cleaned
+      if failures:
+        print "deleted %d old login failures" % failures
+
+      if not loop:
+        break
+      time.sleep(sleep)
+
+class Export(Command):
+  """
+    Stream users, tickets (the attendee list), payments or payment_changes
+    as CSV or NDJSON, to a file or stdout.
+  """
+  option_list = (Option('-t', '--table', dest='table', default='tickets', help="one of %s" % ', '.join(sorted(exports.EXPORTS))),
+                 Option('-f', '--format', dest='format', default='csv', help="csv or ndjson"),
+                 Option('-o', '--output', dest='output', help="file to write to, rather than stdout"),
+                )
+
+  def run(self, table, format, output):
+    if table not in exports.EXPORTS or format not in exports.FORMATS:
+      print "unknown export %s.%s" % (table, format)
+      return 1
+
+    out = open(output, 'w') if output else sys.stdout
+    try:
+      for chunk in exports.export(table, format):
+        out.write(chunk)
+    finally:
+      if output:
+        out.close()
+
+class ExplainQueries(Command):
+  """
+    Check that the hot queries use an index, with EXPLAIN QUERY PLAN.
+    Only runs against SQLite.
+  """
+
+  def queries(self):
+    # the plan only depends on the shape, so any ids will do
+    now = datetime.utcnow()
+    return [
+      ('stock count', db.session.query(Ticket.type_id, Ticket.paid, Ticket.released, func.count(Ticket.id)). \
+        filter(Ticket.type_id.in_([1])). \
+        group_by(Ticket.type_id, Ticket.paid, Ticket.released)),
+      ('expired tickets', db.session.query(Ticket.id, Ticket.type_id). \
+        filter_by(released=False, paid=False). \
+        filter(Ticket.expires < now). \
+        order_by(Ticket.expires).limit(500)),
+      ('ticket limit', Ticket.query.filter_by(user_id=1, type_id=1). \
+        filter(Ticket.expires >= now)),
+      ('stats', Ticket.query.filter_by(type_id=1, paid=True)),
+      ('user tickets', Ticket.query.filter_by(user_id=1).order_by(Ticket.id)),
+      ('payment tickets', Ticket.query.filter(Ticket.payment_id.in_([1, 2, 3]))),
+      ('user payments', Payment.query.filter_by(user_id=1).order_by(Payment.id)),
+      ('outstanding bank payments', BankPayment.query.filter(BankPayment.state == "inprogress"). \
+        order_by(BankPayment.bankref)),
+      ('payment history', PaymentChange.query.filter_by(payment_id=1).order_by(PaymentChange.timestamp)),
+      ('password reset', PasswordReset.query.filter_by(email='a@example.invalid', token='x')),
+      ('email queue', QueuedEmail.query.filter(QueuedEmail.sent == None). \
+        filter(QueuedEmail.next_attempt <= now). \
+        filter(QueuedEmail.attempts < 8). \
+        order_by(QueuedEmail.id).limit(100)),
+      ('webhook inbox', GoCardlessWebhook.query.filter(GoCardlessWebhook.processed == None). \
+        filter(GoCardlessWebhook.error == None). \
+        order_by(GoCardlessWebhook.id).limit(100)),
+    ]
+
+  def run(self):
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite:'):
+      print "EXPLAIN QUERY PLAN is SQLite only"
+      return 1
+
+    ok = True
+    for name, q in self.queries():
+      compiled = q.statement.compile(dialect=db.engine.dialect)
+      params = tuple(compiled.params[k] for k in compiled.positiontup)
+      plan = [row[3] for row in db.engine.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)]
+
+      # a SCAN without an index reads the whole table
+      scans = [p for p in plan if p.startswith('SCAN') and 'INDEX' not in p]
+      print "%s: %s" % (name, 'table scan' if scans else 'OK')
+      for p in plan:
+        print "  ", p
+      if scans:
+        ok = False
+
+    if not ok:
+      return 1
+    print "OK"
+
+# the schema as it was before migrations.py, for checkmigrations
+BASELINE_SCHEMA = """
+CREATE TABLE ticket_type (id INTEGER NOT NULL, name VARCHAR NOT NULL, capacity INTEGER NOT NULL,
+  "limit" INTEGER NOT NULL, cost_pence INTEGER NOT NULL, PRIMARY KEY (id));
+CREATE TABLE password_reset (id INTEGER NOT NULL, email VARCHAR NOT NULL, expires DATETIME NOT NULL,
+  token VARCHAR NOT NULL, PRIMARY KEY (id));
+CREATE TABLE user (id INTEGER NOT NULL, email VARCHAR, name VARCHAR NOT NULL, password VARCHAR NOT NULL,
+  admin BOOLEAN NOT NULL, PRIMARY KEY (id), UNIQUE (email), CHECK (admin IN (0, 1)));
+CREATE TABLE payment (id INTEGER NOT NULL, user_id INTEGER NOT NULL, provider VARCHAR NOT NULL,
+  amount_pence INTEGER NOT NULL, state VARCHAR NOT NULL, bankref VARCHAR, gcid VARCHAR, PRIMARY KEY (id),
+  FOREIGN KEY(user_id) REFERENCES user (id), UNIQUE (bankref), UNIQUE (gcid));
+CREATE TABLE payment_change (id INTEGER NOT NULL, payment_id INTEGER NOT NULL, timestamp DATETIME NOT NULL,
+  state VARCHAR NOT NULL, PRIMARY KEY (id), FOREIGN KEY(payment_id) REFERENCES payment (id));
+CREATE TABLE ticket (id INTEGER NOT NULL, user_id INTEGER NOT NULL, type_id INTEGER NOT NULL,
+  paid BOOLEAN NOT NULL, expires DATETIME NOT NULL, payment_id INTEGER, PRIMARY KEY (id),
+  FOREIGN KEY(user_id) REFERENCES user (id), FOREIGN KEY(type_id) REFERENCES ticket_type (id),
+  CHECK (paid IN (0, 1)), FOREIGN KEY(payment_id) REFERENCES payment (id));
+INSERT INTO ticket_type VALUES (1, 'Prepay Camp Ticket', 250, 4, 3000);
+INSERT INTO user VALUES (1, 'baseline@example.invalid', 'Baseline', 'x', 0);
+INSERT INTO ticket VALUES (1, 1, 1, 0, '2012-06-01 00:00:00.000000', NULL);
+"""
+
+class Migrate(Command):
+  """
+    Create any missing tables and apply pending schema migrations. The site
+    doesn't do this itself, so run it once per deploy before starting it.
+  """
+
+  def run(self):
+    migrate()
+    print "schema at version %d" % SchemaVersion.current()
+
+class CheckMigrations(Command):
+  """
+    Build a database with the schema from before migrations, start the
+    migrate command against it in a fresh process, and check the upgraded schema has
+    every table, column and index the models declare. Uses SQLite.
+  """
+
+  def run(self):
+    tmp = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp, 'baseline.db')
+      conn = sqlite3.connect(path)
+      conn.executescript(BASELINE_SCHEMA)
+      conn.close()
+
+      settings = os.path.join(tmp, 'settings.cfg')
+      out = open(settings, 'w')
+      out.write(open(os.environ['SETTINGS_FILE']).read())
+      out.write('\nSQLALCHEMY_DATABASE_URI = %r\n' % ('sqlite:///' + path))
+      out.close()
+
+      env = dict(os.environ, SETTINGS_FILE=settings)
+      if subprocess.call([sys.executable, 'utils.py', 'migrate'], env=env,
+                         cwd=os.path.dirname(os.path.abspath(__file__))):
+        print "migrating the baseline database failed"
+        return 1
+
+      engine = create_engine('sqlite:///' + path)
+      inspector = Inspector.from_engine(engine)
+      missing = []
+      for table in db.metadata.sorted_tables:
+        if table.name not in inspector.get_table_names():
+          missing.append('table %s' % table.name)
+          continue
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        missing.extend('column %s.%s' % (table.name, c.name) for c in table.columns if c.name not in columns)
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+        missing.extend('index %s' % i.name for i in table.indexes if i.name not in indexes)
+
+      released = engine.execute('SELECT released FROM ticket WHERE id = 1').scalar()
+      engine.dispose()
+    finally:
+      shutil.rmtree(tmp)
+
+    for m in missing:
+      print "missing %s" % m
+    if released is None:
+      print "existing tickets have no released flag"
+    if missing or released is None:
+      return 1
+    print "OK"
+
+class IssueTickets(Command):
+  """
+    Issue a batch of tickets (comps, volunteers) without going through checkout
+  """
+  option_list = (Option('-e', '--email', dest='emails', action='append', help="user to issue to, can be given more than once"),
+                 Option('-f', '--file', dest='filename', help="file of user emails, one per line"),
+                 Option('-t', '--type', dest='type', default='Prepay Camp Ticket', help="ticket type name"),
+                 Option('-n', '--count', dest='count', type=int, default=1, help="tickets per user"),
+                 Option('-u', '--unpaid', action='store_true', help="issue as unpaid reservations expiring after EXPIRY_DAYS"),
+                 Option('-d', '--doit', action='store_true', help="set this to actually change the db"),
+                )
+
+  def run(self, emails, filename, type, count, unpaid, doit):
+    emails = list(emails or [])
+    if filename:
+      emails += [l.strip() for l in file(filename) if l.strip()]
+
+    type = TicketType.query.filter_by(name=type).one()
+    users = User.query.filter(User.email.in_(emails)).all() if emails else []
+    missing = set(emails) - set(u.email for u in users)
+    if missing:
+      for email in sorted(missing):
+        print "no user with email %s" % email
+      return 1
+
+    owners = [u.id for u in users for i in range(count)]
+    expires = None
+    if unpaid:
+      expires = datetime.utcnow() + timedelta(days=app.config.get('EXPIRY_DAYS'))
+
+    try:
+      Ticket.issue(type, owners, expires=expires, paid=not unpaid)
+    except TicketError, e:
+      db.session.rollback()
+      print e
+      return 1
+
+    print "%d %s tickets for %d users" % (len(owners), type.name, len(users))
+    if doit:
+      db.session.commit()
+    else:
+      db.session.rollback()
+      print "not committed, use -d to issue them"
+
+class BenchReconcile(Command):
+  """
+    Time the per-transaction and batched reconcile paths against a
+    synthetic OFX file. Both run without -d. Only runs against SQLite,
+    and removes the payments it creates.
+  """
+  option_list = (Option('-n', '--transactions', dest='transactions', type=int, default=50000, help="transactions in the statement"),
+                 Option('-b', '--batch', dest='batch', type=int, default=500, help="batch size for the batched path"),
+                 Option('-k', '--keep', dest='keep', help="write the generated statement here and keep it"),
+                )
+
+  def run(self, transactions, batch, keep):
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite:'):
+      print "refusing to benchmark against a non-SQLite database"
+      return 1
+
+    run_id = int(time.time())
+    prepay = TicketType.Prepay
+    user = User('benchreconcile-%d@example.invalid' % run_id, 'Bench reconcile')
+    user.password = '!'
+    db.session.add(user)
+    db.session.flush()
+
+    # about a third of the statement pays for something of ours
+    payments = []
+    for i in range(transactions / 3):
+      payment = BankPayment(prepay.cost)
+      payment.set_state('inprogress')
+      user.payments.append(payment)
+      payments.append(payment)
+    db.session.flush()
+    db.session.execute(Ticket.__table__.insert(), [
+      {'user_id': user.id, 'type_id': prepay.id, 'paid': False,
+       'expires': datetime.utcnow() + timedelta(days=10), 'payment_id': p.id}
+      for p in payments])
+    db.session.commit()
+    user_id = user.id
+    refs = [p.bankref for p in payments]
+    print "created %d payments" % len(refs)
+
+    filename = keep or '/tmp/benchreconcile-%d.ofx' % run_id
+    self.write_ofx(filename, transactions, refs, prepay.cost)
+
+    try:
+      for name, batched in (('per transaction', False), ('batched', True)):
+        db.session.remove()
+        r = Reconcile()
+        r.setup(False, True)
+        start = time.time()
+        if batched:
+          r.reconcile_stream(file(filename), batch)
+        else:
+          r.reconcile_file(filename)
+        elapsed = time.time() - start
+        print "%s: %.2fs, %d payments matched, %d unmatched" % (name, elapsed, r.paid, len(r.badrefs))
+
+    finally:
+      db.session.rollback()
+      Ticket.query.filter(Ticket.user_id == user_id).delete(synchronize_session=False)
+      # the history set_state wrote, or SQLite would give it to later payments with the same ids
+      payment_ids = db.session.query(Payment.id).filter(Payment.user_id == user_id).subquery()
+      PaymentChange.query.filter(PaymentChange.payment_id.in_(payment_ids)).delete(synchronize_session=False)
+      Payment.query.filter(Payment.user_id == user_id).delete(synchronize_session=False)
+      User.query.filter_by(id=user_id).delete(synchronize_session=False)
+      db.session.commit()
+      if not keep:
+        os.unlink(filename)
+
+  def write_ofx(self, filename, transactions, refs, cost):
+    out = file(filename, 'w')
+    out.write("<OFX>\n<BANKMSGSRSV1>\n<STMTTRNRS>\n<STMTRS>\n<CURDEF>GBP\n<BANKTRANLIST>\n")
+    for i in range(transactions):
+      if i % 3 == 0 and i / 3 < len(refs):
+        ref = refs[i / 3]
+        trntype, name, amount = 'OTHER', 'J SMITH %s-%s BGC' % (ref[:4], ref[4:]), cost
+      elif i % 3 == 1:
+        trntype, name, amount = 'DIRECTDEP', 'SOMEONE ELSE %06d' % i, Decimal('12.50')
+      else:
+        trntype, name, amount = 'DEBIT', 'SUPPLIER %06d' % i, Decimal('-40.00')
+      out.write("<STMTTRN>\n<TRNTYPE>%s\n<DTPOSTED>20120601\n<TRNAMT>%.2f\n<FITID>%d\n<NAME>%s\n</STMTTRN>\n" %
+                (trntype, amount, 100000 + i, name))
+    out.write("</BANKTRANLIST>\n</STMTRS>\n</STMTTRNRS>\n</BANKMSGSRSV1>\n</OFX>\n")
+    out.close()
+
 
 if __name__ == "__main__":
   manager.add_command('reconcile', Reconcile())
   manager.add_command('testemails', TestEmails())
   manager.add_command('createtickets', CreateTickets())
+  manager.add_command('checkstock', CheckStock())
+  manager.add_command('stresstest', StressTest())
+  manager.add_command('sendmail', SendEmail())
+  manager.add_command('processwebhooks', ProcessWebhooks())
+  manager.add_command('replaywebhooks', ReplayWebhooks())
+  manager.add_command('firewebhook', FireWebhook())
+  manager.add_command('querybudget', QueryBudget())
+  manager.add_command('issuetickets', IssueTickets())
+  manager.add_command('benchreconcile', BenchReconcile())
+  manager.add_command('expiretickets', ExpireTickets())
+  manager.add_command('explainqueries', ExplainQueries())
+  manager.add_command('export', Export())
+  manager.add_command('migrate', Migrate())
+  manager.add_command('checkmigrations', CheckMigrations())
+  manager.add_command('checkoversell', CheckOversell())
   manager.run()
@@ -1,11 +1,18 @@
-from main import app, db, gocardless, mail
-from models.user import User, PasswordReset
-from models.payment import Payment, BankPayment, GoCardlessPayment
-from models.ticket import TicketType, Ticket
+from main import app, db, gocardless
+from models.user import User, PasswordReset, HashingBusy
+from models.payment import Payment, BankPayment, GoCardlessPayment, GoCardlessWebhook
+from models.ticket import TicketType, Ticket, TicketError, reserve_tickets
+from models.outbox import QueuedEmail
+from stats import sales_stats
+from throttle import login_throttle
+from pagecache import cached_page
+from waitingroom import waiting_room, queued
+import exports
+import hitcounter
 
 from flask import \
     render_template, redirect, request, flash, \
-    url_for, abort, send_from_directory, session
+    url_for, abort, send_from_directory, session, jsonify
 from flaskext.login import \
     login_user, login_required, logout_user, current_user
 from flaskext.mail import Message
@@ -15,15 +22,19 @@ from flaskext.wtf import \
     SubmitField, BooleanField, IntegerField, HiddenInput, \
     DecimalField
 
-from sqlalchemy import or_
+from sqlalchemy import or_, func, case
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.sql import text
 
 from decorator import decorator
 import simplejson, os, re
+from decimal import Decimal, InvalidOperation
 from datetime import datetime, timedelta
 
+if app.config.get('PROFILING'):
+    import profiling
+
 def feature_flag(flag):
     def call(f, *args, **kw):
         if app.config.get(flag, False) == True:
@@ -49,6 +60,7 @@ class IntegerSelectField(SelectField):
 
 
 @app.route("/")
+@cached_page
 def main():
     return render_template('main.html')
 
@@ -58,11 +70,13 @@ def favicon():
                                    'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
 @app.route("/sponsors")
+@cached_page
 def sponsors():
     return render_template('sponsors.html')
 
 
 @app.route("/about/company")
+@cached_page
 def company():
     return render_template('company.html')
 
@@ -86,11 +100,28 @@ class LoginForm(Form):
 def login():
     form = LoginForm(request.form, next=request.args.get('next'))
     if request.method == 'POST' and form.validate():
-        user = User.query.filter_by(email=form.email.data).first()
-        if user and user.check_password(form.password.data):
+        ip, email = request.remote_addr, form.email.data
+        if login_throttle.blocked(ip, email):
+            flash("Too many failed logins, please try again in a few minutes")
+            return render_template("login.html", form=form)
+
+        user = User.query.filter_by(email=email).first()
+        try:
+            ok = user and user.check_password(form.password.data)
+            if ok and user.needs_rehash():
+                # BCRYPT_LOG_ROUNDS has changed since this was hashed
+                user.set_password(form.password.data)
+                db.session.commit()
+        except HashingBusy:
+            flash("We're very busy right now, please try again in a moment")
+            return render_template("login.html", form=form)
+
+        if ok:
+            login_throttle.succeeded(ip, email)
             login_user(user)
             return redirect(form.next.data or url_for('tickets'))
         else:
+            login_throttle.failed(ip, email)
             flash("Invalid login details!")
     return render_template("login.html", form=form)
 
@@ -110,21 +141,26 @@ def signup():
 
     if request.method == 'POST' and form.validate():
         user = User(form.email.data, form.name.data)
-        user.set_password(form.password.data)
-        db.session.add(user)
         try:
-            db.session.commit()
-        except IntegrityError, e:
-            flash("Email address %s is already in use, please use another or reset your password" % (form.email.data))
-            return redirect(url_for('signup'))
-        login_user(user)
+            user.set_password(form.password.data)
+        except HashingBusy:
+            flash("We're very busy right now, please try again in a moment")
+            return render_template("signup.html", form=form)
+        db.session.add(user)
 
         # send a welcome email.
         msg = Message("Welcome to Electromagnetic Field",
                 sender=app.config.get('TICKETS_EMAIL'),
                 recipients=[user.email])
         msg.body = render_template("welcome-email.txt", user=user)
-        mail.send(msg)
+        db.session.add(QueuedEmail(msg))
+
+        try:
+            db.session.commit()
+        except IntegrityError, e:
+            flash("Email address %s is already in use, please use another or reset your password" % (form.email.data))
+            return redirect(url_for('signup'))
+        login_user(user)
 
         return redirect(form.next.data or url_for('tickets'))
 
@@ -148,12 +184,12 @@ def forgot_password():
             reset = PasswordReset(form.email.data)
             reset.new_token()
             db.session.add(reset)
-            db.session.commit()
             msg = Message("EMF password reset",
                 sender=app.config.get('TICKETS_EMAIL'),
                 recipients=[form.email.data])
             msg.body = render_template("reset-password-email.txt", user=form._user, reset=reset)
-            mail.send(msg)
+            db.session.add(QueuedEmail(msg))
+            db.session.commit()
 
         return redirect(url_for('reset_password', email=form.email.data))
     return render_template("forgot-password.html", form=form)
@@ -178,8 +214,12 @@ def reset_password():
     form = ResetPasswordForm(request.form, email=request.args.get('email'), token=request.args.get('token'))
     if request.method == 'POST' and form.validate():
         user = User.query.filter_by(email=form.email.data).first()
+        try:
+            user.set_password(form.password.data)
+        except HashingBusy:
+            flash("We're very busy right now, please try again in a moment")
+            return render_template("reset-password.html", form=form)
         db.session.delete(form._reset)
-        user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
         return redirect(url_for('tickets'))
@@ -198,7 +238,7 @@ class ChoosePrepayTicketsForm(Form):
 
     def validate_count(form, field):
         prepays = current_user.tickets. \
-            filter_by(type=TicketType.Prepay).\
+            filter_by(type_id=TicketType.Prepay.id).\
             filter(Ticket.expires >= datetime.utcnow()). \
             count()
         if field.data + prepays > TicketType.Prepay.limit:
@@ -206,6 +246,7 @@ class ChoosePrepayTicketsForm(Form):
 
 @app.route("/tickets", methods=['GET', 'POST'])
 @feature_flag('PAYMENTS')
+@queued
 @login_required
 def tickets():
     form = ChoosePrepayTicketsForm(request.form)
@@ -215,8 +256,12 @@ def tickets():
         session["count"] = form.count.data
         return redirect(url_for('pay_choose'))
 
-    tickets = current_user.tickets.all()
-    payments = current_user.payments.all()
+    # payments and tickets are dynamic relationships, so can't be eager
+    # loaded from the user. Keep this to one query each.
+    tickets = Ticket.query.filter_by(user_id=current_user.id). \
+        options(joinedload('type')). \
+        order_by(Ticket.id).all()
+    payments = current_user.payments.order_by(Payment.id).all()
 
     #
     # go through existing payments
@@ -258,33 +303,33 @@ def buy_prepay_tickets(paymenttype, count):
     """
     Temporary procedure to create a payment from session data
     """
-    prepays = current_user.tickets. \
-        filter_by(type=TicketType.Prepay).\
-        filter(Ticket.expires >= datetime.utcnow()). \
-        count()
-    if prepays + count > TicketType.Prepay.limit:
-        raise Exception('You can only buy %s tickets in total' % TicketType.Prepay.limit)
-
-    tickets = [Ticket(type_id=TicketType.Prepay.id) for i in range(count)]
-
-    amount = sum(t.type.cost for t in tickets)
-
+    amount = TicketType.Prepay.cost * count
     payment = paymenttype(amount)
-    current_user.payments.append(payment)
+    expires = datetime.utcnow() + timedelta(days=app.config.get('EXPIRY_DAYS'))
 
-    for t in tickets:
-        current_user.tickets.append(t)
-        t.payment = payment
-        t.expires = datetime.utcnow() + timedelta(days=app.config.get('EXPIRY_DAYS'))
-
-    db.session.add(current_user)
-    db.session.commit()
+    reserve_tickets(current_user, TicketType.Prepay, count, payment, expires)
 
     return payment
 
 
+@app.route("/queue")
+@feature_flag('PAYMENTS')
+def queue():
+    if not app.config.get('WAITING_ROOM') or waiting_room.admitted():
+        return redirect(url_for('tickets'))
+    return render_template('queue.html', status=waiting_room.status(),
+        poll=app.config.get('WAITING_ROOM_POLL', 5))
+
+@app.route("/queue/status")
+@feature_flag('PAYMENTS')
+def queue_status():
+    if not app.config.get('WAITING_ROOM'):
+        return jsonify(admitted=True)
+    return jsonify(waiting_room.status())
+
 @app.route("/pay")
 @feature_flag('PAYMENTS')
+@cached_page
 def pay():
     if current_user.is_authenticated():
         return redirect(url_for('pay_choose'))
@@ -293,12 +338,14 @@ def pay():
 
 @app.route("/pay/terms")
 @feature_flag('PAYMENTS')
+@cached_page
 def ticket_terms():
     return render_template('terms.html')
 
 
 @app.route("/pay/choose")
 @feature_flag('PAYMENTS')
+@queued
 @login_required
 def pay_choose():
     count = session.get('count')
@@ -311,6 +358,7 @@ def pay_choose():
 
 @app.route("/pay/gocardless-start", methods=['POST'])
 @feature_flag('PAYMENTS')
+@queued
 @login_required
 def gocardless_start():
     count = session.pop('count', None)
@@ -318,7 +366,11 @@ def gocardless_start():
         flash('Your session information has been lost. Please try ordering again.')
         return redirect(url_for('tickets'))
 
-    payment = buy_prepay_tickets(GoCardlessPayment, count)
+    try:
+        payment = buy_prepay_tickets(GoCardlessPayment, count)
+    except TicketError, e:
+        flash(str(e))
+        return redirect(url_for('tickets'))
 
     app.logger.info("User %s created GoCardless payment %s", current_user.id, payment.id)
 
@@ -403,7 +455,7 @@ def gocardless_tryagain():
             db.session.delete(t)
             app.logger.info("Canceling Gocardless ticket %d (u:%d p:%d)", t.id, current_user.id, payment.id)
         app.logger.info("Canceling Gocardless payment %d (u:%d)", payment.id, current_user.id)
-        payment.state = "canceled"
+        payment.set_state("canceled")
         db.session.add(payment)
         db.session.commit()
         flash("Your gocardless payment has been canceled")
@@ -434,13 +486,15 @@ def gocardless_complete():
         flash("An error occurred with your payment, please contact %s" % app.config.get('TICKETS_EMAIL')[1])
         return redirect(url_for('tickets'))
 
+    if payment.state != "new":
+        # a reload
+        app.logger.info("Payment %s is already %s", payment.id, payment.state)
+        return redirect(url_for('gocardless_waiting', payment=payment_id))
+
     # keep the gocardless reference so we can find the payment when we get called by the webhook
     payment.gcid = gcid
-    payment.state = "inprogress"
+    payment.set_state("inprogress")
     db.session.add(payment)
-    db.session.commit()
-
-    app.logger.info("Payment completed OK")
 
     # should we send the resource_uri in the bill email?
     msg = Message("Your EMF ticket purchase", \
@@ -450,7 +504,10 @@ def gocardless_complete():
     msg.body = render_template("tickets-purchased-email-gocardless.txt", \
         basket={"count" : len(payment.tickets.all()), "reference" : gcid}, \
         user = payment.user, payment=payment)
-    mail.send(msg)
+    db.session.add(QueuedEmail(msg))
+    db.session.commit()
+
+    app.logger.info("Payment completed OK")
 
     return redirect(url_for('gocardless_waiting', payment=payment_id))
 
@@ -492,7 +549,7 @@ def gocardless_cancel():
 
     for t in payment.tickets:
         app.logger.info("gocardless-cancel: userid %s, payment_id %s canceled ticket %d",
-            current_user.id, payment.id, ticket.id)
+            current_user.id, payment.id, t.id)
         t.payment = None
 
     db.session.add(current_user)
@@ -511,7 +568,8 @@ def gocardless_webhook():
         
         we mostly want 'bill'
         
-        GoCardless limits the webhook to 5 secs. this should run async...
+        GoCardless limits the webhook to 5 secs, so we just store the
+        payload here and the processwebhooks command in utils.py does the rest.
 
     """
     json_data = simplejson.loads(request.data)
@@ -531,52 +589,27 @@ def gocardless_webhook():
         app.logger.warn('Unknown action')
         return ('', 501)
 
-    # action can be:
-    #
-    # paid -> money taken from the customers account, at this point we concider the ticket paid.
-    # created -> for subscriptions
-    # failed -> customer is broke
-    # withdrawn -> we actually get the money
+    if GoCardlessWebhook.query.filter_by(signature=data['signature']).count():
+        app.logger.info("gocardless-webhook: already received, ignoring")
+        return ('', 200)
 
-    for bill in data['bills']:
-        gcid = bill['id']
-        try:
-            payment = GoCardlessPayment.query.filter_by(gcid=gcid).one()
-        except NoResultFound:
-            app.logger.warn('Payment %s not found, ignoring', gcid)
-            continue
-
-        app.logger.info("Processing payment %s (%s) for user %s",
-            payment.id, gcid, payment.user.id)
-
-        if data['action'] == 'paid':
-            if payment.state != "inprogress":
-                app.logger.warning("Old payment state was %s, not 'inprogress'", payment.state)
-
-            for t in payment.tickets.all():
-                t.paid = True
-
-            payment.state = "paid"
-            db.session.add(payment)
-            db.session.commit()
-
-            msg = Message("Your EMF ticket payment has been confirmed", \
-                sender=app.config.get('TICKETS_EMAIL'),
-                recipients=[payment.user.email]
-            )
-            msg.body = render_template("tickets-paid-email-gocardless.txt", \
-                basket={"count" : len(payment.tickets.all()), "reference" : gcid}, \
-                user = payment.user, payment=payment)
-            mail.send(msg)
+    hook = GoCardlessWebhook(data)
+    db.session.add(hook)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # redelivered while we were handling the first one
+        db.session.rollback()
+        return ('', 200)
 
-        else:
-            app.logger.debug('Payment: %s', bill)
+    app.logger.info("gocardless-webhook: stored as %s", hook.id)
 
     return ('', 200)
 
 
 @app.route("/pay/transfer-start", methods=['POST'])
 @feature_flag('PAYMENTS')
+@queued
 @login_required
 def transfer_start():
     count = session.pop('count', None)
@@ -584,13 +617,16 @@ def transfer_start():
         flash('Your session information has been lost. Please try ordering again.')
         return redirect(url_for('tickets'))
 
-    payment = buy_prepay_tickets(BankPayment, count)
+    try:
+        payment = buy_prepay_tickets(BankPayment, count)
+    except TicketError, e:
+        flash(str(e))
+        return redirect(url_for('tickets'))
 
     app.logger.info("User %s created bank payment %s (%s)", current_user.id, payment.id, payment.bankref)
 
-    payment.state = "inprogress"
+    payment.set_state("inprogress")
     db.session.add(payment)
-    db.session.commit()
 
     msg = Message("Your EMF ticket purchase", \
         sender=app.config.get('TICKETS_EMAIL'), \
@@ -599,7 +635,8 @@ def transfer_start():
     msg.body = render_template("tickets-purchased-email-banktransfer.txt", \
         basket={"count" : len(payment.tickets.all()), "reference" : payment.bankref}, \
         user = current_user, payment=payment)
-    mail.send(msg)
+    db.session.add(QueuedEmail(msg))
+    db.session.commit()
 
     return redirect(url_for('transfer_waiting', payment=payment.id))
 
@@ -656,7 +693,7 @@ def transfer_cancel():
             db.session.delete(t)
             app.logger.info("Canceling bank transfer ticket %d (u:%d p:%d)", t.id, current_user.id, payment.id)
         app.logger.info("Canceling bank transfer payment %d (u:%d)", payment.id, current_user.id)
-        payment.state = "canceled"
+        payment.set_state("canceled")
         db.session.add(payment)
         db.session.commit()
         flash('payment canceled')
@@ -665,16 +702,15 @@ def transfer_cancel():
 
 @app.route("/stats")
 def stats():
-    ret = {}
-    conn = db.session.connection()
-    result = conn.execute(text("""SELECT count(t.id) as tickets from payment p, ticket t, ticket_type tt where
-                                p.state='inprogress' and t.payment_id = p.id and t.expires >= date('now') and t.type_id = tt.id and tt.name = 'Prepay Camp Ticket'""")).fetchall()
-    ret["prepays"] = result[0][0]
-    ret["users"] = User.query.count()
-    ret["prepays_bought"] = TicketType.Prepay.query.filter(Ticket.paid == True).count()
-
+    ret = sales_stats.summary()
     return ' '.join('%s:%s' % i for i in ret.items())
 
+@app.route("/stats.json")
+def stats_json():
+    if current_user.is_authenticated() and current_user.admin:
+        return jsonify(sales_stats.get())
+    return jsonify(sales_stats.public())
+
 @app.route("/admin")
 @login_required
 def admin():
@@ -683,89 +719,180 @@ def admin():
     else:
         return(('', 404))
 
+def like_escape(text):
+    # for LIKE patterns, with escape='\\'
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def keyset_page(query, column, after, size):
+    """
+    A page of query ordered by column, starting after the given value.
+    Returns the items and the value to start the next page after, or None.
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    items = query.order_by(column).limit(size + 1).all()
+    if len(items) > size:
+        items = items[:size]
+        return items, getattr(items[-1], column.key)
+    return items, None
+
 class ManualReconcileForm(Form):
-    payment = HiddenField('payment_id', [Required()])
-    reconcile = SubmitField('Reconcile')
+    payments = HiddenField('payment_ids')
+    reconcile = SubmitField('Mark selected paid')
     yes = SubmitField('Yes')
     no = SubmitField('No')
 
+def reconcile_filters():
+    # the queue's filters, to carry through the confirmation and redirect
+    return dict((k, request.args[k]) for k in ('ref', 'amount', 'age') if request.args.get(k))
+
+def reconcile_queue(filters, after, size):
+    # late transfers can still arrive for expired payments
+    q = BankPayment.query.filter(BankPayment.state.in_(["inprogress", "expired"])). \
+        options(joinedload('user'))
+
+    if filters.get('ref'):
+        ref = filters['ref'].replace('-', '').strip().upper()
+        q = q.filter(BankPayment.bankref.like(like_escape(ref) + '%', escape='\\'))
+    if filters.get('amount'):
+        try:
+            q = q.filter(BankPayment.amount_pence == int(Decimal(filters['amount']) * 100))
+        except (InvalidOperation, ValueError, OverflowError):
+            # ValueError for NaN and OverflowError for Infinity, from int()
+            flash("Invalid amount %s" % filters['amount'])
+    if filters.get('age', '').isdigit():
+        # tickets expire EXPIRY_DAYS after they're reserved
+        reserved_before = datetime.utcnow() - timedelta(days=int(filters['age']))
+        q = q.filter(BankPayment.tickets.any(Ticket.expires <
+            reserved_before + timedelta(days=app.config.get('EXPIRY_DAYS'))))
+
+    payments, next_after = keyset_page(q, BankPayment.bankref, after, size)
+
+    counts = {}
+    if payments:
+        counts = dict((id, (count, paid)) for id, count, paid in
+            db.session.query(Ticket.payment_id, func.count(Ticket.id),
+                             func.sum(case([(Ticket.paid == True, 1)], else_=0))). \
+            filter(Ticket.payment_id.in_([p.id for p in payments])). \
+            group_by(Ticket.payment_id))
+    return payments, counts, next_after
+
+def mark_paid(ids):
+    """
+    Mark bank payments and their tickets paid, queueing an email for
+    each. Returns the payments. Doesn't commit.
+    """
+    payments = BankPayment.query.filter(BankPayment.id.in_(ids)). \
+        filter(BankPayment.state.in_(["inprogress", "expired"])). \
+        options(joinedload('user')).all()
+    tickets = {}
+    for t in Ticket.query.filter(Ticket.payment_id.in_([p.id for p in payments])).options(joinedload('type')):
+        tickets.setdefault(t.payment_id, []).append(t)
+
+    for payment in payments:
+        app.logger.info("%s Manually reconciled payment %d (%s)", current_user.name, payment.id, payment.bankref)
+        for t in tickets.get(payment.id, []):
+            t.paid = True
+            app.logger.info("ticket %d (%s, for %s) paid", t.id, t.type.name, payment.user.name)
+        payment.set_state("paid")
+
+        msg = Message("Electromagnetic Field ticket purchase update", \
+                  sender=app.config.get('TICKETS_EMAIL'), \
+                  recipients=[payment.user.email]
+                 )
+        msg.body = render_template("tickets-paid-email-banktransfer.txt", \
+                  basket={"count" : len(tickets.get(payment.id, [])), "reference" : payment.bankref}, \
+                  user = payment.user, payment=payment
+                 )
+        db.session.add(QueuedEmail(msg))
+    return payments
+
 @app.route("/admin/manual_reconcile", methods=['GET', 'POST'])
 @login_required
 def manual_reconcile():
     if current_user.admin:
+        filters = reconcile_filters()
         if request.method == "POST":
             form = ManualReconcileForm()
             if form.validate():
                 if form.yes.data == True:
-                    payment = BankPayment.query.get(int(form.payment.data))
-                    app.logger.info("%s Manually reconciled payment %d (%s)", current_user.name, payment.id, payment.bankref)
-                    for t in payment.tickets:
-                        t.paid = True
-                        db.session.add(t)
-                        app.logger.info("ticket %d (%s, for %s) paid", t.id, t.type.name, payment.user.name)
-                    payment.state = "paid"
-                    db.session.add(payment)
-                    db.session.commit()
-                
-                    # send email.
-                    msg = Message("Electromagnetic Field ticket purchase update", \
-                              sender=app.config.get('TICKETS_EMAIL'), \
-                              recipients=[payment.user.email]
-                             )
-                    msg.body = render_template("tickets-paid-email-banktransfer.txt", \
-                              basket={"count" : len(payment.tickets.all()), "reference" : payment.bankref}, \
-                              user = payment.user, payment=payment
-                             )
-                    mail.send(msg)
-                
-                    flash("Payment ID %d now marked as paid" % (payment.id))
-                    return redirect(url_for('manual_reconcile'))
+                    ids = [int(id) for id in form.payments.data.split(',') if id.isdigit()]
+                    try:
+                        payments = mark_paid(ids)
+                        db.session.commit()
+                    except TicketError, e:
+                        db.session.rollback()
+                        flash("Nothing marked as paid: %s" % e)
+                    else:
+                        flash("%d payments now marked as paid" % len(payments))
+                    return redirect(url_for('manual_reconcile', **filters))
                 elif form.no.data == True:
-                    return redirect(url_for('manual_reconcile'))
+                    return redirect(url_for('manual_reconcile', **filters))
                 elif form.reconcile.data == True:
-                    payment = BankPayment.query.get(int(form.payment.data))
-                    ynform = ManualReconcileForm(payment=payment.id, formdata=None)
-                    return render_template('admin_manual_reconcile_yesno.html', ynform=ynform, payment=payment)
-
-        payments = BankPayment.query.filter(BankPayment.state == "inprogress").order_by(BankPayment.bankref).all()
-        paymentforms = {}
-        for p in payments:
-            paymentforms[p.id] = ManualReconcileForm(payment=p.id, formdata=None)
-        return render_template('admin_manual_reconcile.html', payments=payments, paymentforms=paymentforms)
+                    ids = [int(id) for id in request.form.getlist('payment') if id.isdigit()]
+                    if not ids:
+                        flash("No payments selected")
+                        return redirect(url_for('manual_reconcile', **filters))
+                    payments = BankPayment.query.filter(BankPayment.id.in_(ids)). \
+                        options(joinedload('user')).order_by(BankPayment.bankref).all()
+                    ynform = ManualReconcileForm(payments=','.join(str(p.id) for p in payments), formdata=None)
+                    return render_template('admin_manual_reconcile_yesno.html', ynform=ynform,
+                        payments=payments, total=sum(p.amount for p in payments), filters=filters)
+
+        after = request.args.get('after')
+        payments, counts, next_after = reconcile_queue(filters, after, app.config.get('ADMIN_PAGE_SIZE', 50))
+        form = ManualReconcileForm(formdata=None)
+        return render_template('admin_manual_reconcile.html', payments=payments, counts=counts,
+            form=form, filters=filters, after=after, next_after=next_after)
     else:
         return(('', 404))
 
+class MakeAdminForm(Form):
+    ids = HiddenField('ids')
+    change = SubmitField('Change')
+
+def make_admin_form(ids, users=None, **kwargs):
+    # a fresh class each time, with a checkbox for each user on the page
+    class PageForm(MakeAdminForm):
+        pass
+    for id in ids:
+        default = users[id].admin if users else False
+        setattr(PageForm, 'admin_%d' % id, BooleanField('admin', default=default))
+    return PageForm(ids=','.join(str(id) for id in ids), **kwargs)
+
 @app.route("/admin/make_admin", methods=['GET', 'POST'])
 @login_required
 def make_admin():
-    # TODO : paginate?
-
     if current_user.admin:
-        
-        class MakeAdminForm(Form):
-            change = SubmitField('Change')
-            
-        users = User.query.order_by(User.id).all()
-        # The list of users can change between the
-        # form being generated and it being submitted, but the id's should remain stable
-        for u in users:
-            setattr(MakeAdminForm, str(u.id) + "_admin", BooleanField('admin', default=u.admin))
-        
+        q = request.args.get('q', '').strip()
+        after = request.args.get('after', type=int)
+
         if request.method == 'POST':
-            form = MakeAdminForm()
+            ids = [int(id) for id in request.form.get('ids', '').split(',') if id.isdigit()]
+            form = make_admin_form(ids)
             if form.validate():
-                for field in form:
-                    if field.name.endswith('_admin'):
-                        id = int(field.name.split("_")[0])
-                        user = User.query.get(id)
-                        if user.admin != field.data:
-                            app.logger.info("user %s (%d) admin: %s -> %s" % (user.name, user.id, user.admin, field.data))
-                            user.admin = field.data
-                            db.session.add(user)
-                            db.session.commit()
-                return redirect(url_for('make_admin'))
-        adminform = MakeAdminForm(formdata=None)
-        return render_template('admin_make_admin.html', users=users, adminform = adminform)
+                users = User.query.filter(User.id.in_(ids)).all() if ids else []
+                changes = {}
+                for user in users:
+                    admin = form['admin_%d' % user.id].data
+                    if user.admin != admin:
+                        app.logger.info("user %s (%d) admin: %s -> %s" % (user.name, user.id, user.admin, admin))
+                        changes[user.id] = admin
+                User.set_admin(changes)
+                db.session.commit()
+                flash("Updated %d users" % len(changes))
+            return redirect(url_for('make_admin', q=q or None, after=after))
+
+        users = User.query
+        if q:
+            pattern = '%' + like_escape(q) + '%'
+            users = users.filter(or_(User.email.ilike(pattern, escape='\\'),
+                                     User.name.ilike(pattern, escape='\\')))
+        users, next_after = keyset_page(users, User.id, after, app.config.get('ADMIN_PAGE_SIZE', 50))
+
+        adminform = make_admin_form([u.id for u in users], dict((u.id, u) for u in users), formdata=None)
+        return render_template('admin_make_admin.html', users=users, adminform=adminform,
+            q=q, after=after, next_after=next_after)
     else:
         return(('', 404))
 
@@ -793,3 +920,27 @@ def ticket_types():
         return render_template('admin_ticket_types.html', types=types, form=form)
     else:
         return(('', 404))
+
+@app.route("/admin/export/<name>.<format>")
+@login_required
+def admin_export(name, format):
+    if current_user.admin and name in exports.EXPORTS and format in exports.FORMATS:
+        filename = '%s-%s.%s' % (name, datetime.utcnow().strftime('%Y%m%d-%H%M%S'), format)
+        return app.response_class(exports.export(name, format), mimetype=exports.FORMATS[format],
+            headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+    else:
+        return(('', 404))
+
+@app.route("/admin/profile")
+@feature_flag('PROFILING')
+@login_required
+def admin_profile():
+    if current_user.admin:
+        endpoints = profiling.stats.summary()
+        caches = hitcounter.cache_summary()
+        if request.args.get('format') == 'json':
+            return jsonify(endpoints=endpoints, caches=caches)
+        return render_template('admin_profile.html', endpoints=endpoints, caches=caches,
+            fields=profiling.FIELDS, percentiles=profiling.PERCENTILES)
+    else:
+        return(('', 404))
@@ -0,0 +1,149 @@
+"""
+A waiting room in front of the checkout, for when sales open.
+
+With WAITING_ROOM on, views decorated with @queued send visitors
+to /queue until it's their turn. A new visitor is only given the time
+they joined, in their (signed) session cookie. When they come back with
+it they get a QueueToken, whose id is their place in line, so clients
+that don't keep cookies never touch the database.
+
+Places are let in at WAITING_ROOM_RATE a second, but never more than
+there are prepay tickets left. Everyone who went through to the
+checkout in the last WAITING_ROOM_WINDOW seconds counts as about to take
+one, as does anyone let in too recently to have come back yet. Tokens
+older than WAITING_ROOM_TOKEN_AGE are deleted by expiretickets.
+
+Each process looks at the queue at most once a second, and the queue
+page polls a view that answers from that, so waiting costs next to
+nothing.
+"""
+from main import app, db
+from models.admission import QueueToken, QueueState
+from models.ticket import TicketType, TicketStock
+from flask import session, redirect, url_for
+from flaskext.login import current_user
+from sqlalchemy import func, or_, and_
+from sqlalchemy.exc import IntegrityError
+from decorator import decorator
+from datetime import datetime, timedelta
+import threading
+import time
+
+class WaitingRoom(object):
+    # after a quiet spell, let in at most this many seconds' worth at once
+    max_burst = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.admitted_upto = 0
+        self.remaining = None
+        self.headroom = None
+        self.waiting = 0
+        self.checked = 0
+
+    def rate(self):
+        return app.config.get('WAITING_ROOM_RATE', 5)
+
+    def refresh(self):
+        with self.lock:
+            if time.time() - self.checked < 1:
+                return
+            try:
+                self.advance()
+            except IntegrityError:
+                # another process created the state row first
+                db.session.rollback()
+                self.advance()
+            self.checked = time.time()
+
+    def advance(self):
+        state = QueueState.get()
+        now = datetime.utcnow()
+        window = timedelta(seconds=app.config.get('WAITING_ROOM_WINDOW', 900))
+
+        prepay = TicketType.Prepay
+        stock = TicketStock.query.get(prepay.id)
+        self.remaining = max(prepay.capacity - (stock.allocated if stock else 0), 0)
+
+        # long enough for someone we've let in to see it and come back
+        grace = timedelta(seconds=2 * app.config.get('WAITING_ROOM_POLL', 5))
+
+        waiting = max((db.session.query(func.max(QueueToken.id)).scalar() or 0) - state.admitted_upto, 0)
+        in_flight = QueueToken.query.filter(or_(
+            QueueToken.entered > now - window,
+            and_(QueueToken.entered == None, QueueToken.admitted > now - grace))).count()
+        elapsed = min((now - state.advanced).total_seconds(), max(self.max_burst, 1.0 / self.rate()))
+        self.headroom = self.remaining - in_flight
+        step = min(int(self.rate() * elapsed), self.headroom, waiting)
+
+        if step > 0:
+            # only one process gets to move the queue on from here
+            updated = QueueState.query.filter_by(id=state.id, advanced=state.advanced). \
+                update({QueueState.admitted_upto: state.admitted_upto + step,
+                        QueueState.advanced: now}, synchronize_session=False)
+            if updated:
+                QueueToken.query.filter(QueueToken.id > state.admitted_upto). \
+                    filter(QueueToken.id <= state.admitted_upto + step). \
+                    update({QueueToken.admitted: now}, synchronize_session=False)
+        db.session.commit()
+        self.admitted_upto = QueueState.get().admitted_upto
+        self.waiting = waiting
+
+    def position(self):
+        """
+        The visitor's place in line, or None if they've only just joined.
+        """
+        if 'queue_position' in session:
+            return session['queue_position']
+        if 'queue_joined' not in session:
+            session['queue_joined'] = time.time()
+            return None
+        token = QueueToken(datetime.utcfromtimestamp(session['queue_joined']))
+        db.session.add(token)
+        db.session.commit()
+        session['queue_position'] = token.id
+        return token.id
+
+    def admitted(self):
+        if session.get('queue_admitted'):
+            return True
+        position = self.position()
+        self.refresh()
+        if position is not None and position <= self.admitted_upto:
+            QueueToken.query.filter_by(id=position). \
+                update({QueueToken.entered: datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+            session['queue_admitted'] = True
+            return True
+        return False
+
+    def status(self):
+        admitted = self.admitted()
+        position = session.get('queue_position')
+        if admitted:
+            ahead = 0
+        elif position is None:
+            # not in line yet, so behind everyone who is
+            ahead = self.waiting
+        else:
+            ahead = position - self.admitted_upto - 1
+        return {
+            'admitted': admitted,
+            'ahead': ahead,
+            'wait': int(ahead / float(self.rate())),
+            'sold_out': self.remaining == 0,
+            # everything left is with people we've already let in
+            'paused': self.headroom <= 0,
+        }
+
+waiting_room = WaitingRoom()
+
+def queued(f):
+    def call(f, *args, **kw):
+        if not app.config.get('WAITING_ROOM') or \
+                (current_user.is_authenticated() and current_user.admin):
+            return f(*args, **kw)
+        if waiting_room.admitted():
+            return f(*args, **kw)
+        return redirect(url_for('queue'))
+    return decorator(call, f)